@@ -0,0 +1,198 @@
+"""Local stand-ins for every external service the bot talks to, with configurable latency and errors."""
+import asyncio
+import dataclasses
+import random
+import time
+
+from aiohttp import web
+
+SUMMARY_TEXT = "This is a summary produced by the benchmark stand-in. " * 4
+# A few KB of bytes stand in for the synthesized MP3
+AUDIO_BYTES = b"\xff\xfb\x90\x00" * 4096
+
+LOREM = (
+    "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore "
+    "et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut "
+    "aliquip ex ea commodo consequat. "
+)
+
+
+@dataclasses.dataclass
+class FakeServiceSettings:
+    feed_latency: float = 0.05
+    llm_latency: float = 0.5
+    tts_latency: float = 0.5
+    telegram_latency: float = 0.05
+    # Time a self-hosted ollama spends loading a model that is not the currently loaded one
+    model_swap_latency: float = 2.0
+    # Share of feed, LLM, TTS and Telegram requests that fail with a 500
+    error_rate: float = 0.0
+    entry_paragraphs: int = 10
+
+
+class FakeServices:
+    """Serves RSS feeds, the OpenAI, ollama, Cloudflare AI, Kokoro and Telegram Bot APIs under one address."""
+
+    def __init__(self, settings: FakeServiceSettings, host: str = "127.0.0.1", port: int = 0):
+        self.settings = settings
+        self.host = host
+        self.port = port
+        self.runner = None
+        self.loaded_ollama_model = None
+        self.ollama_model_swaps = 0
+        self.ollama_lock = asyncio.Lock()
+        self.message_id = 0
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def environment(self, bot_token: str) -> dict:
+        """The environment variables that point the bot at these stand-ins."""
+        return {
+            "OPENAI_BASE_URL": f"{self.base_url}/openai/v1",
+            "OPENAI_API_KEY": "benchmark",
+            "OLLAMA_HOST": f"{self.base_url}/ollama",
+            "CLOUDFLARE_AI_API_BASE_URL": f"{self.base_url}/cloudflare/",
+            "CLOUDFLARE_AI_API_KEY": "benchmark",
+            "CLOUDFLARE_AI_GATEWAY_API_KEY": "benchmark",
+            "KOKORO_BASE_URL": f"{self.base_url}/kokoro/v1",
+            "TELEGRAM_API_BASE_URL": f"{self.base_url}/telegram/bot",
+            "TELEGRAM_BOT_TOKEN": bot_token,
+            "TELEGRAM_CHAT_ID": "1",
+        }
+
+    def feed_url(self, feed_index: int, entry_count: int) -> str:
+        return f"{self.base_url}/feeds/{feed_index}?entries={entry_count}"
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get("/feeds/{feed_index}", self.feed)
+        app.router.add_post("/openai/v1/chat/completions", self.openai_chat)
+        app.router.add_post("/ollama/api/chat", self.ollama_chat)
+        app.router.add_post("/ollama/api/generate", self.ollama_generate)
+        app.router.add_post("/cloudflare/{model:.+}", self.cloudflare_run)
+        app.router.add_post("/kokoro/v1/audio/speech", self.kokoro_speech)
+        app.router.add_post("/telegram/bot{token}/{method}", self.telegram_method)
+
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def _failed(self) -> bool:
+        return random.random() < self.settings.error_rate
+
+    async def feed(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.settings.feed_latency)
+        if self._failed():
+            return web.Response(text="Injected error", status=500)
+        feed_index = request.match_info["feed_index"]
+        entry_count = int(request.query.get("entries", "10"))
+        description = LOREM * self.settings.entry_paragraphs
+        items = "".join(
+            f"<item><title>Entry {entry_index} of feed {feed_index}</title>"
+            f"<link>http://benchmark.invalid/{feed_index}/{entry_index}</link>"
+            f"<guid>benchmark-{feed_index}-{entry_index}</guid>"
+            f"<description>{description}</description></item>"
+            for entry_index in range(entry_count)
+        )
+        return web.Response(
+            text=f'<?xml version="1.0"?><rss version="2.0"><channel><title>Feed {feed_index}</title>{items}</channel></rss>',
+            content_type="application/rss+xml",
+        )
+
+    async def openai_chat(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        await asyncio.sleep(self.settings.llm_latency)
+        if self._failed():
+            return web.json_response({"error": {"message": "Injected error"}}, status=500)
+        return web.json_response(
+            {
+                "id": "chatcmpl-benchmark",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": SUMMARY_TEXT},
+                        "finish_reason": "stop",
+                    }
+                ],
+            }
+        )
+
+    async def _load_ollama_model(self, model: str):
+        # A single GPU only holds one model, so requests for another model wait for a swap
+        if self.loaded_ollama_model != model:
+            self.ollama_model_swaps += 1
+            await asyncio.sleep(self.settings.model_swap_latency)
+            self.loaded_ollama_model = model
+
+    async def ollama_chat(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        async with self.ollama_lock:
+            await self._load_ollama_model(body["model"])
+            await asyncio.sleep(self.settings.llm_latency)
+        if self._failed():
+            return web.json_response({"error": "Injected error"}, status=500)
+        return web.json_response(
+            {
+                "model": body["model"],
+                "created_at": "2025-01-01T00:00:00Z",
+                "message": {"role": "assistant", "content": SUMMARY_TEXT},
+                "done": True,
+            }
+        )
+
+    async def ollama_generate(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        async with self.ollama_lock:
+            await self._load_ollama_model(body["model"])
+        return web.json_response(
+            {"model": body["model"], "created_at": "2025-01-01T00:00:00Z", "response": "", "done": True}
+        )
+
+    async def cloudflare_run(self, request: web.Request) -> web.Response:
+        await request.json()
+        await asyncio.sleep(self.settings.llm_latency)
+        if self._failed():
+            return web.json_response({"success": False}, status=500)
+        return web.json_response({"success": True, "result": {"response": SUMMARY_TEXT}})
+
+    async def kokoro_speech(self, request: web.Request) -> web.Response:
+        await request.json()
+        await asyncio.sleep(self.settings.tts_latency)
+        if self._failed():
+            return web.json_response({"detail": "Injected error"}, status=500)
+        return web.Response(body=AUDIO_BYTES, content_type="audio/mpeg")
+
+    async def telegram_method(self, request: web.Request) -> web.Response:
+        # Uploads arrive as multipart data, which only has to be drained
+        await request.read()
+        await asyncio.sleep(self.settings.telegram_latency)
+        method = request.match_info["method"]
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+        elif self._failed():
+            return web.json_response(
+                {"ok": False, "error_code": 500, "description": "Internal Server Error: injected error"}, status=500
+            )
+        else:
+            self.message_id += 1
+            result = {
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": 1, "type": "private"},
+            }
+            # Sent files come back with the id Telegram stores them under
+            if method == "sendAudio":
+                result["audio"] = {"file_id": f"audio-{self.message_id}", "file_unique_id": f"audio-{self.message_id}", "duration": 1}
+            elif method == "sendVoice":
+                result["voice"] = {"file_id": f"voice-{self.message_id}", "file_unique_id": f"voice-{self.message_id}", "duration": 1}
+        return web.json_response({"ok": True, "result": result})
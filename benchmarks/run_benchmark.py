@@ -0,0 +1,215 @@
+"""
+End-to-end benchmark of RSSSummarizer.summarize_rss_feeds and cron_send against local stand-ins.
+
+Every feed count x entry count x model count scenario runs in a fresh process against a fresh DB, and
+reports throughput, p50/p99 latency per stage, peak RSS and DB query counts.
+
+Usage: python benchmarks/run_benchmark.py --feeds 1 5 --entries 10 50 --models 1 3
+"""
+import argparse
+import asyncio
+import collections
+import glob
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+from fake_services import FakeServices, FakeServiceSettings
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), "llm_summarize")
+
+BOT_TOKEN = "123456:benchmark"
+
+# Models are spread over these providers in turn
+MODEL_PROVIDER_CLASSES = ["OpenAISummarizer", "OllamaSummarizer", "CloudflareAISummarizer"]
+
+
+def _percentile(values: list, percentile: float) -> float:
+    ordered_values = sorted(values)
+    return ordered_values[max(0, math.ceil(percentile * len(ordered_values)) - 1)]
+
+
+def _stage_latencies(trace_dir: str) -> dict:
+    durations = collections.defaultdict(list)
+    for trace_path in glob.glob(os.path.join(trace_dir, "*.json")):
+        with open(trace_path) as trace_file:
+            for event in json.load(trace_file)["traceEvents"]:
+                if event["ph"] == "X":
+                    durations[event["name"]].append(event["dur"] / 1000)
+
+    return {
+        stage: {
+            "count": len(stage_durations),
+            "p50_ms": round(_percentile(stage_durations, 0.5), 2),
+            "p99_ms": round(_percentile(stage_durations, 0.99), 2),
+        }
+        for stage, stage_durations in sorted(durations.items())
+    }
+
+
+async def _run_scenario(feed_urls: list, model_count: int, db_url: str, trace_dir: str) -> dict:
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.orm import sessionmaker
+    from telegram.ext import CallbackContext
+
+    import db
+    from rss_llm.rss_summarizer import RSSSummarizer
+    from telegram_ui import telegram_bot
+
+    engine = create_engine(db_url)
+    db.Base.metadata.drop_all(engine)
+    db.Base.metadata.create_all(engine)
+    db_queries = db.Queries(sessionmaker(bind=engine)())
+
+    for feed_index, feed_url in enumerate(feed_urls):
+        db_queries.insert_rss_feed(name=f"feed-{feed_index}", url=feed_url)
+    for model_index in range(model_count):
+        provider_class = MODEL_PROVIDER_CLASSES[model_index % len(MODEL_PROVIDER_CLASSES)]
+        db_queries.insert_model(
+            name=f"benchmark-{model_index}-{provider_class}",
+            provider_class=provider_class,
+            provider_specific_id=f"benchmark-{model_index}",
+        )
+
+    query_counts = collections.Counter()
+    phase = "scan"
+
+    def count_query(*args):
+        query_counts[phase] += 1
+
+    event.listen(engine, "before_cursor_execute", count_query)
+
+    scan_error = None
+    scan_start = time.perf_counter()
+    try:
+        await RSSSummarizer(db_queries).summarize_rss_feeds()
+    except Exception as e:
+        scan_error = repr(e)
+    scan_seconds = time.perf_counter() - scan_start
+
+    phase = "setup"
+    summary_count = len(db_queries.select_unsent_summaries())
+
+    phase = "send"
+    application = telegram_bot.init_telegram_bot_application(BOT_TOKEN, db_queries)
+    send_errors = 0
+    send_start = time.perf_counter()
+    async with application:
+        context = CallbackContext(application)
+        for _ in range(math.ceil(summary_count / telegram_bot.MAX_SUMMARIES_PER_SEND)):
+            try:
+                await telegram_bot.cron_send(context)
+            except Exception:
+                # The job queue logs a failed send and tries again on the next tick
+                send_errors += 1
+    send_seconds = time.perf_counter() - send_start
+
+    return {
+        "feeds": len(feed_urls),
+        "models": model_count,
+        "scan_seconds": round(scan_seconds, 3),
+        "scan_error": scan_error,
+        "summaries": summary_count,
+        "summaries_per_second": round(summary_count / scan_seconds, 2),
+        "send_seconds": round(send_seconds, 3),
+        "sends_per_second": round(summary_count / send_seconds, 2) if summary_count else 0,
+        "send_errors": send_errors,
+        "db_queries": {"scan": query_counts["scan"], "send": query_counts["send"]},
+        "stages": _stage_latencies(trace_dir),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def run_scenario(feed_urls: list, model_count: int, db_url: str, work_dir: str) -> dict:
+    # Runs in a fresh process, so that settings are read on import and peak RSS only covers this scenario
+    logging.basicConfig(level=logging.WARNING)
+    trace_dir = os.path.join(work_dir, "traces")
+    os.environ["TRACE_DIR"] = trace_dir
+    # Audio files are written to the working directory
+    os.chdir(work_dir)
+    sys.path.insert(0, PACKAGE_DIR)
+    return asyncio.run(_run_scenario(feed_urls, model_count, db_url, trace_dir))
+
+
+def _print_result(result: dict):
+    print(
+        f"\n== {result['feeds']} feeds x {result['entries']} entries x {result['models']} models ==\n"
+        f"scan: {result['scan_seconds']}s, {result['summaries']} summaries, {result['summaries_per_second']}/s"
+        f"{', failed with ' + result['scan_error'] if result['scan_error'] else ''}\n"
+        f"send: {result['send_seconds']}s, {result['sends_per_second']}/s"
+        f"{', ' + str(result['send_errors']) + ' failed sends' if result['send_errors'] else ''}\n"
+        f"db queries: {result['db_queries']['scan']} during scan, {result['db_queries']['send']} during send\n"
+        f"ollama model swaps: {result['ollama_model_swaps']}\n"
+        f"peak RSS: {result['peak_rss_mb']} MB"
+    )
+    print(f"{'stage':<45}{'count':>8}{'p50 ms':>12}{'p99 ms':>12}")
+    for stage, latencies in result["stages"].items():
+        print(f"{stage:<45}{latencies['count']:>8}{latencies['p50_ms']:>12}{latencies['p99_ms']:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--feeds", type=int, nargs="+", default=[1, 5])
+    parser.add_argument("--entries", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--models", type=int, nargs="+", default=[1, 3])
+    parser.add_argument(
+        "--db-url",
+        default=None,
+        help="A sqlalchemy connection string of a throwaway DB, all tables are dropped. Defaults to a new SQLite file per scenario",
+    )
+    parser.add_argument("--feed-latency", type=float, default=FakeServiceSettings.feed_latency)
+    parser.add_argument("--llm-latency", type=float, default=FakeServiceSettings.llm_latency)
+    parser.add_argument("--tts-latency", type=float, default=FakeServiceSettings.tts_latency)
+    parser.add_argument("--telegram-latency", type=float, default=FakeServiceSettings.telegram_latency)
+    parser.add_argument("--model-swap-latency", type=float, default=FakeServiceSettings.model_swap_latency)
+    parser.add_argument("--error-rate", type=float, default=FakeServiceSettings.error_rate)
+    parser.add_argument("--json", default=None, help="Also write the results to this file")
+    args = parser.parse_args()
+
+    services = FakeServices(
+        FakeServiceSettings(
+            feed_latency=args.feed_latency,
+            llm_latency=args.llm_latency,
+            tts_latency=args.tts_latency,
+            telegram_latency=args.telegram_latency,
+            model_swap_latency=args.model_swap_latency,
+            error_rate=args.error_rate,
+        )
+    )
+    services_loop = asyncio.new_event_loop()
+    threading.Thread(target=services_loop.run_forever, daemon=True).start()
+    asyncio.run_coroutine_threadsafe(services.start(), services_loop).result()
+    os.environ.update(services.environment(BOT_TOKEN))
+
+    results = []
+    process_context = multiprocessing.get_context("spawn")
+    for feed_count, entry_count, model_count in itertools.product(args.feeds, args.entries, args.models):
+        with tempfile.TemporaryDirectory() as work_dir:
+            db_url = args.db_url or f"sqlite:///{os.path.join(work_dir, 'benchmark.db')}"
+            feed_urls = [services.feed_url(feed_index, entry_count) for feed_index in range(feed_count)]
+            ollama_model_swaps = services.ollama_model_swaps
+            with process_context.Pool(1) as pool:
+                result = pool.apply(run_scenario, (feed_urls, model_count, db_url, work_dir))
+            result["entries"] = entry_count
+            result["ollama_model_swaps"] = services.ollama_model_swaps - ollama_model_swaps
+        _print_result(result)
+        results.append(result)
+
+    asyncio.run_coroutine_threadsafe(services.stop(), services_loop).result()
+
+    if args.json:
+        with open(args.json, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Startup time benchmark of a RUN_MODE=oneshot run that finds nothing to do, which is what most cron runs look like.
+
+Usage: python benchmarks/startup_benchmark.py --runs 10
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), "llm_summarize")
+
+
+def _timed_run(command: list, environment: dict) -> float:
+    start = time.perf_counter()
+    subprocess.run(command, cwd=PACKAGE_DIR, env=environment, check=True, capture_output=True)
+    return time.perf_counter() - start
+
+
+def _report(name: str, durations: list):
+    print(
+        f"{name:<40}median {statistics.median(durations) * 1000:>8.1f} ms"
+        f"   min {min(durations) * 1000:>8.1f} ms   max {max(durations) * 1000:>8.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        environment = dict(
+            os.environ,
+            RUN_MODE="oneshot",
+            DB_CONNECTION_STRING=f"sqlite:///{os.path.join(work_dir, 'startup.db')}",
+        )
+        # The first run creates the schema, like the first run of a new deployment
+        first_run = _timed_run([sys.executable, "llm_summarize.py"], environment)
+        print(f"{'oneshot run creating the schema':<40}{first_run * 1000:>15.1f} ms")
+
+        _report(
+            "oneshot run",
+            [_timed_run([sys.executable, "llm_summarize.py"], environment) for _ in range(args.runs)],
+        )
+        _report(
+            "interpreter only",
+            [_timed_run([sys.executable, "-c", "pass"], environment) for _ in range(args.runs)],
+        )
+        _report(
+            "persistent mode imports",
+            [
+                _timed_run([sys.executable, "-c", "import telegram_ui.telegram_bot"], environment)
+                for _ in range(args.runs)
+            ],
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,26 @@
 import logging
 
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import Boolean, Column, ForeignKey, PrimaryKeyConstraint, String
+from sqlalchemy import (
+    JSON, BigInteger, Boolean, Column, DateTime, ForeignKey, Integer, PrimaryKeyConstraint, String, and_, func,
+    inspect, or_, text,
+)
 from sqlalchemy.dialects.postgresql import TEXT
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql.expression import false, true
 from sqlalchemy.dialects.postgresql import JSONB
 
+import metrics
+from delivery import SUMMARY_CHANNEL, summary_notification_payload
+
 Base = declarative_base()
 
+# Bumped whenever a column or an index is added to an existing table, so that only outdated DBs are inspected on start
+SCHEMA_VERSION = 3
+
+# Deliveries to a subscribed chat are given up after this many failed sends, so they do not hold up the others
+MAX_DELIVERY_ATTEMPTS = 5
+
 logger = logging.getLogger(__name__)
 
 
@@ -18,6 +30,10 @@ class RssFeed(Base):
     name = Column(String(128), primary_key=True)
     url = Column(String(512), nullable=False)
     active = Column(Boolean(), default=True)
+    # Download the linked page of entries that only come with a teaser
+    fetch_full_text = Column(Boolean(), default=False)
+    # Only this model summarizes the feed when set, whatever the input length
+    model_name = Column(ForeignKey("models.name"), nullable=True)
 
 
 class RSSEntry(Base):
@@ -25,7 +41,8 @@ class RSSEntry(Base):
 
     feed_name = Column(ForeignKey("rss_feeds.name"), nullable=False)
     feed_entry_id = Column(TEXT, nullable=False)
-    raw_content = Column(JSONB, nullable=False)
+    # JSONB on Postgres, plain JSON elsewhere so the schema also works on SQLite
+    raw_content = Column(JSON().with_variant(JSONB, "postgresql"), nullable=False)
 
     __table_args__ = (PrimaryKeyConstraint("feed_name", "feed_entry_id"),)
 
@@ -37,6 +54,9 @@ class Model(Base):
     provider_class = Column(String(512), nullable=False)
     provider_specific_id = Column(String(512), nullable=False)
     active = Column(Boolean(), default=True)
+    # The model only gets entries within these input token counts, no limit when empty
+    min_input_tokens = Column(Integer, nullable=True)
+    max_input_tokens = Column(Integer, nullable=True)
 
 
 class Summary(Base):
@@ -48,15 +68,90 @@ class Summary(Base):
     content = Column(TEXT)
     title = Column(TEXT)
     audio_file_path = Column(TEXT)
+    # The Telegram id of the uploaded audio, so that it is only uploaded once no matter how many chats get it
+    audio_file_id = Column(TEXT)
+    # Identifies the summary in the callback data of its TTS button, which is limited to 64 bytes
+    audio_token = Column(String(32), index=True)
+    # Whether the summary was sent to TELEGRAM_CHAT_ID, deliveries to subscribed chats are in summary_deliveries
     sent = Column(Boolean(), default=False)
+    created_at = Column(DateTime(), default=func.now())
 
     __table_args__ = (PrimaryKeyConstraint("feed_name", "model_name", "feed_entry_id"),)
 
 
+class Subscription(Base):
+    __tablename__ = "subscriptions"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(BigInteger, nullable=False)
+    feed_name = Column(ForeignKey("rss_feeds.name"), nullable=False)
+    # Summaries from every model of the feed when empty
+    model_name = Column(ForeignKey("models.name"), nullable=True)
+    # Only summaries created after the subscription are delivered
+    created_at = Column(DateTime(), default=func.now())
+
+
+class SummaryDelivery(Base):
+    __tablename__ = "summary_deliveries"
+
+    feed_name = Column(ForeignKey("rss_feeds.name"), nullable=False)
+    model_name = Column(ForeignKey("models.name"), nullable=False)
+    feed_entry_id = Column(TEXT, nullable=False)
+    chat_id = Column(BigInteger, nullable=False)
+    # Failed sends are recorded as undelivered, and retried until MAX_DELIVERY_ATTEMPTS
+    delivered = Column(Boolean(), default=True)
+    # Set once the text is sent, so a delivery whose audio failed only retries the audio
+    text_delivered = Column(Boolean(), default=False)
+    failed_attempts = Column(Integer, default=0)
+
+    __table_args__ = (PrimaryKeyConstraint("feed_name", "model_name", "feed_entry_id", "chat_id"),)
+
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True)
+
+
+def select_schema_version(engine) -> int:
+    with engine.connect() as connection:
+        return connection.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+
+
+def _column_definition(column, dialect) -> str:
+    column_definition = f"{column.name} {column.type.compile(dialect)}"
+    for foreign_key in column.foreign_keys:
+        column_definition += f" REFERENCES {foreign_key.column.table.name} ({foreign_key.column.name})"
+    return column_definition
+
+
+def migrate_schema(engine, table_names: list):
+    """Add the columns and indexes that were added to the models after their tables were created."""
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table_name in table_names:
+            table = Base.metadata.tables[table_name]
+            existing_column_names = {column["name"] for column in inspector.get_columns(table_name)}
+            for column in table.columns:
+                if column.name not in existing_column_names:
+                    logger.info(f"Adding column {column.name} to table {table_name}")
+                    connection.execute(
+                        text(f"ALTER TABLE {table_name} ADD COLUMN {_column_definition(column, engine.dialect)}")
+                    )
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+        connection.execute(SchemaVersion.__table__.delete())
+        connection.execute(SchemaVersion.__table__.insert().values(version=SCHEMA_VERSION))
+
+
 class Queries:
     def __init__(self, session):
         self.session = session
+        # Called with the key of every summary inserted by this process, after it is committed
+        self.summary_listeners = []
 
+    @metrics.db_query_timer("insert_summary")
     def insert_summary(self, feed_name: str, feed_entry_id: str, model_name: str, content: str, title: str, audio_file_path: str):
         try:
             new_summary = Summary(
@@ -68,12 +163,25 @@ class Queries:
                 audio_file_path=audio_file_path
             )
             self.session.add(new_summary)
+            if self.session.bind.dialect.name == "postgresql":
+                # Delivered to listening processes when the transaction commits
+                self.session.execute(
+                    text("SELECT pg_notify(:channel, :payload)"),
+                    {
+                        "channel": SUMMARY_CHANNEL,
+                        "payload": summary_notification_payload(feed_name, model_name, feed_entry_id),
+                    },
+                )
             self.session.commit()
         except Exception as e:
             self.session.rollback()
             raise Exception(f"Error inserting summary: {str(e)}")
 
+        for summary_listener in self.summary_listeners:
+            summary_listener(feed_name, model_name, feed_entry_id)
 
+
+    @metrics.db_query_timer("select_existing_summary_from_model")
     def select_existing_summary_from_model(self, feed_entry_id: str, model_name: str
     ) -> bool:
         summary = (
@@ -86,6 +194,7 @@ class Queries:
 
         return summary is not None
 
+    @metrics.db_query_timer("select_existing_raw_feed_content")
     def select_existing_raw_feed_content(
         self, feed_name: str, feed_entry_id: str,
     ) -> bool:
@@ -100,6 +209,20 @@ class Queries:
         return summary is not None
 
 
+    @metrics.db_query_timer("select_summary")
+    def select_summary(self, feed_name: str, model_name: str, feed_entry_id: str):
+        return (
+            self.session.query(Summary)
+            .filter(
+                Summary.feed_name == feed_name,
+                Summary.model_name == model_name,
+                Summary.feed_entry_id == feed_entry_id,
+            )
+            .first()
+        )
+
+
+    @metrics.db_query_timer("update_summary_sent")
     def update_summary_sent(self, feed_name: str, model_name: int, feed_entry_id: str
     ):
         summary = (
@@ -117,12 +240,187 @@ class Queries:
             self.session.commit()
 
 
+    @metrics.db_query_timer("select_unsent_summaries")
     def select_unsent_summaries(self) -> list:
         unsent_summaries = self.session.query(Summary).filter(Summary.sent == false()).all()
 
         return unsent_summaries
 
 
+    def _pending_deliveries(self):
+        # Summaries and subscribed chats that have no delivery yet, the failed attempts are selected to order by them
+        failed_attempts = func.coalesce(SummaryDelivery.failed_attempts, 0).label("failed_attempts")
+        return (
+            self.session.query(Summary, Subscription.chat_id, failed_attempts)
+            .join(
+                Subscription,
+                and_(
+                    Subscription.feed_name == Summary.feed_name,
+                    or_(Subscription.model_name.is_(None), Subscription.model_name == Summary.model_name),
+                    Summary.created_at >= Subscription.created_at,
+                ),
+            )
+            .outerjoin(
+                SummaryDelivery,
+                and_(
+                    SummaryDelivery.feed_name == Summary.feed_name,
+                    SummaryDelivery.model_name == Summary.model_name,
+                    SummaryDelivery.feed_entry_id == Summary.feed_entry_id,
+                    SummaryDelivery.chat_id == Subscription.chat_id,
+                ),
+            )
+            .filter(
+                or_(
+                    SummaryDelivery.chat_id.is_(None),
+                    and_(
+                        SummaryDelivery.delivered == false(),
+                        SummaryDelivery.failed_attempts < MAX_DELIVERY_ATTEMPTS,
+                    ),
+                )
+            )
+            .distinct()
+            .order_by(failed_attempts, Summary.created_at)
+        )
+
+
+    @metrics.db_query_timer("select_pending_deliveries")
+    def select_pending_deliveries(self, limit: int, chat_id: int = None) -> list:
+        """Pairs of summaries and the chats they are pending for, the ones that failed before come last."""
+        pending_deliveries = self._pending_deliveries()
+        if chat_id is not None:
+            pending_deliveries = pending_deliveries.filter(Subscription.chat_id == chat_id)
+        return [(summary, chat_id) for summary, chat_id, _ in pending_deliveries.limit(limit).all()]
+
+
+    @metrics.db_query_timer("select_pending_delivery_chat_ids")
+    def select_pending_delivery_chat_ids(self, summary: Summary) -> list:
+        pending_deliveries = self._pending_deliveries().filter(
+            Summary.feed_name == summary.feed_name,
+            Summary.model_name == summary.model_name,
+            Summary.feed_entry_id == summary.feed_entry_id,
+        )
+        return [chat_id for _, chat_id, _ in pending_deliveries.all()]
+
+
+    @metrics.db_query_timer("insert_summary_delivery")
+    def insert_summary_delivery(self, summary: Summary, chat_id: int):
+        summary_delivery = self._summary_delivery(summary, chat_id)
+        summary_delivery.delivered = True
+        self.session.commit()
+
+
+    @metrics.db_query_timer("select_summary_delivery")
+    def select_summary_delivery(self, summary: Summary, chat_id: int):
+        return self.session.get(
+            SummaryDelivery, (summary.feed_name, summary.model_name, summary.feed_entry_id, chat_id)
+        )
+
+
+    @metrics.db_query_timer("update_summary_delivery_text_delivered")
+    def update_summary_delivery_text_delivered(self, summary: Summary, chat_id: int):
+        summary_delivery = self._summary_delivery(summary, chat_id)
+        # Still pending until the audio is delivered as well
+        summary_delivery.delivered = False
+        summary_delivery.text_delivered = True
+        self.session.commit()
+
+
+    @metrics.db_query_timer("update_summary_delivery_failed")
+    def update_summary_delivery_failed(self, summary: Summary, chat_id: int):
+        summary_delivery = self._summary_delivery(summary, chat_id)
+        summary_delivery.delivered = False
+        summary_delivery.failed_attempts = (summary_delivery.failed_attempts or 0) + 1
+        self.session.commit()
+
+
+    def _summary_delivery(self, summary: Summary, chat_id: int) -> SummaryDelivery:
+        summary_delivery = self.select_summary_delivery(summary, chat_id)
+        if summary_delivery is None:
+            summary_delivery = SummaryDelivery(
+                feed_name=summary.feed_name,
+                model_name=summary.model_name,
+                feed_entry_id=summary.feed_entry_id,
+                chat_id=chat_id,
+                failed_attempts=0,
+            )
+            self.session.add(summary_delivery)
+        return summary_delivery
+
+
+    @metrics.db_query_timer("update_summary_audio_file_id")
+    def update_summary_audio_file_id(self, summary: Summary, audio_file_id: str):
+        summary.audio_file_id = audio_file_id
+        self.session.commit()
+
+
+    @metrics.db_query_timer("update_summary_audio_file_path")
+    def update_summary_audio_file_path(self, summary: Summary, audio_file_path: str):
+        summary.audio_file_path = audio_file_path
+        self.session.commit()
+
+
+    @metrics.db_query_timer("update_summary_audio_token")
+    def update_summary_audio_token(self, summary: Summary, audio_token: str):
+        summary.audio_token = audio_token
+        self.session.commit()
+
+
+    @metrics.db_query_timer("select_summary_by_audio_token")
+    def select_summary_by_audio_token(self, audio_token: str):
+        return self.session.query(Summary).filter(Summary.audio_token == audio_token).first()
+
+
+    @metrics.db_query_timer("insert_subscription")
+    def insert_subscription(self, chat_id: int, feed_name: str, model_name: str = None) -> bool:
+        existing_subscription = (
+            self.session.query(Subscription)
+            .filter(
+                Subscription.chat_id == chat_id,
+                Subscription.feed_name == feed_name,
+                Subscription.model_name.is_(None) if model_name is None else Subscription.model_name == model_name,
+            )
+            .first()
+        )
+        if existing_subscription:
+            return False
+
+        try:
+            self.session.add(Subscription(chat_id=chat_id, feed_name=feed_name, model_name=model_name))
+            self.session.commit()
+        except Exception as e:
+            self.session.rollback()
+            raise Exception(f"Error inserting subscription: {str(e)}")
+        return True
+
+
+    @metrics.db_query_timer("delete_subscription")
+    def delete_subscription(self, chat_id: int, feed_name: str, model_name: str = None) -> bool:
+        deleted_count = (
+            self.session.query(Subscription)
+            .filter(
+                Subscription.chat_id == chat_id,
+                Subscription.feed_name == feed_name,
+                Subscription.model_name.is_(None) if model_name is None else Subscription.model_name == model_name,
+            )
+            .delete()
+        )
+        self.session.commit()
+
+        return deleted_count > 0
+
+
+    @metrics.db_query_timer("delete_chat_subscriptions")
+    def delete_chat_subscriptions(self, chat_id: int):
+        self.session.query(Subscription).filter(Subscription.chat_id == chat_id).delete()
+        self.session.commit()
+
+
+    @metrics.db_query_timer("select_chat_subscriptions")
+    def select_chat_subscriptions(self, chat_id: int) -> list:
+        return self.session.query(Subscription).filter(Subscription.chat_id == chat_id).all()
+
+
+    @metrics.db_query_timer("insert_rss_feed")
     def insert_rss_feed(self, name: str, url: str):
         try:
             new_feed = RssFeed(name=name, url=url)
@@ -133,6 +431,29 @@ class Queries:
             raise Exception(f"Error inserting RSS feed: {str(e)}")
 
 
+    @metrics.db_query_timer("update_rss_feed_full_text")
+    def update_rss_feed_full_text(self, name: str, fetch_full_text: bool) -> bool:
+        rss_feed = self.session.query(RssFeed).filter(RssFeed.name == name).first()
+
+        if rss_feed:
+            rss_feed.fetch_full_text = fetch_full_text
+            self.session.commit()
+
+        return rss_feed is not None
+
+
+    @metrics.db_query_timer("update_rss_feed_model")
+    def update_rss_feed_model(self, name: str, model_name: str = None) -> bool:
+        rss_feed = self.session.query(RssFeed).filter(RssFeed.name == name).first()
+
+        if rss_feed:
+            rss_feed.model_name = model_name
+            self.session.commit()
+
+        return rss_feed is not None
+
+
+    @metrics.db_query_timer("delete_rss_feed")
     def delete_rss_feed(self, name: str):
         rss_feed = self.session.query(RssFeed).filter(RssFeed.name == name).first()
 
@@ -141,12 +462,14 @@ class Queries:
             self.session.commit()
 
 
+    @metrics.db_query_timer("select_active_rss_feeds")
     def select_active_rss_feeds(self) -> list:
         active_feeds = self.session.query(RssFeed).filter(RssFeed.active == true()).all()
 
         return active_feeds
 
 
+    @metrics.db_query_timer("insert_model")
     def insert_model(self, name: str, provider_class: str, provider_specific_id: str
     ):
         try:
@@ -162,6 +485,7 @@ class Queries:
             raise Exception(f"Error inserting model: {str(e)}")
 
 
+    @metrics.db_query_timer("delete_model")
     def delete_model(self, name: str):
         model = self.session.query(Model).filter(Model.name == name).first()
 
@@ -170,12 +494,26 @@ class Queries:
             self.session.commit()
 
 
+    @metrics.db_query_timer("update_model_input_tokens")
+    def update_model_input_tokens(self, name: str, min_input_tokens: int = None, max_input_tokens: int = None) -> bool:
+        model = self.session.query(Model).filter(Model.name == name).first()
+
+        if model:
+            model.min_input_tokens = min_input_tokens
+            model.max_input_tokens = max_input_tokens
+            self.session.commit()
+
+        return model is not None
+
+
+    @metrics.db_query_timer("select_active_models")
     def select_active_models(self) -> list:
         active_models = self.session.query(Model).filter(Model.active == true()).all()
 
         return active_models
 
 
+    @metrics.db_query_timer("insert_rss_feed_entry")
     def insert_rss_feed_entry(self, feed_name: str, feed_entry_id: str, content: str
     ):
         try:
@@ -0,0 +1,51 @@
+import asyncio
+import json
+import logging
+
+from sqlalchemy.engine import URL
+
+# The Postgres channel that carries the keys of new summaries between processes
+SUMMARY_CHANNEL = "summaries"
+POSTGRES_RECONNECT_DELAY = 5
+
+logger = logging.getLogger(__name__)
+
+
+def summary_notification_payload(feed_name: str, model_name: str, feed_entry_id: str) -> str:
+    return json.dumps([feed_name, model_name, feed_entry_id])
+
+
+class SummaryQueue:
+    """The keys of summaries that are ready for delivery, each key is queued at most once at a time."""
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.pending_keys = set()
+
+    def put(self, feed_name: str, model_name: str, feed_entry_id: str):
+        summary_key = (feed_name, model_name, feed_entry_id)
+        if summary_key in self.pending_keys:
+            return
+        self.pending_keys.add(summary_key)
+        self.queue.put_nowait(summary_key)
+
+    async def get(self) -> tuple:
+        summary_key = await self.queue.get()
+        self.pending_keys.discard(summary_key)
+        return summary_key
+
+    async def listen_postgres(self, db_url: URL):
+        """Queue the summaries inserted by other processes, as announced on SUMMARY_CHANNEL."""
+        import psycopg
+
+        connection_string = db_url.set(drivername="postgresql").render_as_string(hide_password=False)
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(connection_string, autocommit=True) as connection:
+                    await connection.execute(f"LISTEN {SUMMARY_CHANNEL}")
+                    logger.info(f"Listening for new summaries on the {SUMMARY_CHANNEL} channel")
+                    async for notification in connection.notifies():
+                        self.put(*json.loads(notification.payload))
+            except psycopg.Error as e:
+                logger.error(f"Lost the connection listening for new summaries: {e}")
+                await asyncio.sleep(POSTGRES_RECONNECT_DELAY)
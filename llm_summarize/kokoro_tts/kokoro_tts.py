@@ -1,16 +1,79 @@
+import asyncio
+import functools
+import logging
+import os
 
-import openai
+import metrics
+
+KOKORO_BASE_URL = os.environ.get("KOKORO_BASE_URL", "http://kokoro-tts:8880/v1")
+
+# One of Kokoro's response formats, opus audio is sent as Telegram voice notes
+TTS_AUDIO_FORMAT = os.environ.get("TTS_AUDIO_FORMAT", "mp3")
+# An optional bitrate like "24k", the audio is transcoded locally with ffmpeg when it is set
+TTS_AUDIO_BITRATE = os.environ.get("TTS_AUDIO_BITRATE", None)
+
+# When summaries are voiced: "scan" during the scan, "delivery" just before they are sent, "button" when a listener asks
+TTS_MODE = os.environ.get("TTS_MODE", "scan")
+# How many summaries ahead of the one being sent are voiced in delivery mode
+TTS_PREFETCH = int(os.environ.get("TTS_PREFETCH", "2"))
+
+AUDIO_FILE_EXTENSIONS = {"mp3": "mp3", "opus": "ogg", "aac": "aac", "flac": "flac", "wav": "wav", "pcm": "pcm"}
+# Only lossy formats have a bitrate to set
+FFMPEG_AUDIO_ARGUMENTS = {
+    "mp3": ["-c:a", "libmp3lame"],
+    "opus": ["-c:a", "libopus", "-application", "voip"],
+    "aac": ["-c:a", "aac"],
+}
+
+logger = logging.getLogger(__name__)
+
+
+@functools.cache
+def client():
+    # openai is only imported once audio is needed, since it is slow to import
+    import openai
+
+    return openai.AsyncOpenAI(
+        base_url=KOKORO_BASE_URL, api_key="not-needed"
+    )
+
+
+def is_voice_note(audio_file_path: str) -> bool:
+    return audio_file_path.endswith(f'.{AUDIO_FILE_EXTENSIONS["opus"]}')
+
+
+async def _transcode(fname: str, audio_format: str, bitrate: str):
+    if audio_format not in FFMPEG_AUDIO_ARGUMENTS:
+        logger.warning(f"Can not set the bitrate of {audio_format} audio")
+        return
+
+    transcoded_fname = f"transcoded-{fname}"
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-y", "-loglevel", "error", "-i", fname,
+            *FFMPEG_AUDIO_ARGUMENTS[audio_format], "-b:a", bitrate, transcoded_fname,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        logger.warning("ffmpeg is not installed, keeping the audio as returned by Kokoro")
+        return
+    _, stderr = await process.communicate()
+    if process.returncode != 0:
+        logger.warning(f"Could not transcode {fname}: {stderr.decode()}")
+        return
+    os.replace(transcoded_fname, fname)
 
-client = openai.AsyncOpenAI(
-    base_url="http://kokoro-tts:8880/v1", api_key="not-needed"
-)
 
 async def create_audio_file_docker(text: str, title: str):
-    fname = f'{title}.mp3'
-    response = await client.audio.speech.create(
-        model="kokoro",
-        voice="af_bella", #single or multiple voicepack combo
-        input=text
-      )
-    response.write_to_file(fname)
-    return fname
\ No newline at end of file
+    fname = f'{title}.{AUDIO_FILE_EXTENSIONS[TTS_AUDIO_FORMAT]}'
+    with metrics.IN_FLIGHT_REQUESTS.labels("tts").track_inprogress(), metrics.TTS_SECONDS.time():
+        response = await client().audio.speech.create(
+            model="kokoro",
+            voice="af_bella", #single or multiple voicepack combo
+            input=text,
+            response_format=TTS_AUDIO_FORMAT,
+          )
+        response.write_to_file(fname)
+        if TTS_AUDIO_BITRATE:
+            await _transcode(fname, TTS_AUDIO_FORMAT, TTS_AUDIO_BITRATE)
+    return fname
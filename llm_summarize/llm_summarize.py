@@ -2,9 +2,8 @@ import asyncio
 import logging
 import os
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.orm import Session, sessionmaker
-from telegram_ui.telegram_bot import run_persistent, run_oneshot
 
 import db
 
@@ -16,20 +15,34 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 
 logger = logging.getLogger(__name__)
 
-# RUN_MODE can be either PERSISTENT or ONESHOT
+# RUN_MODE can be either PERSISTENT, WEBHOOK or ONESHOT
 RUN_MODE = os.environ.get("RUN_MODE", "PERSISTENT")
 
 def init_db_session() -> Session:
     engine = create_engine(os.getenv("DB_CONNECTION_STRING", "NONE"))
-    db.Base.metadata.create_all(engine)
+    # Listing the existing tables is a single query, instead of one per table for create_all
+    existing_table_names = inspect(engine).get_table_names()
+    if not set(db.Base.metadata.tables).issubset(existing_table_names):
+        logger.info("Creating the DB schema")
+        db.Base.metadata.create_all(engine)
+    if db.select_schema_version(engine) < db.SCHEMA_VERSION:
+        logger.info("Migrating the DB schema")
+        db.migrate_schema(engine, [name for name in db.Base.metadata.tables if name in existing_table_names])
     session = sessionmaker(bind=engine)
     return session()
 
 
-db_session = init_db_session()
-
 if __name__ == "__main__":
+    # Each mode only imports what it needs, oneshot runs are started often and should start fast
     if RUN_MODE.lower() == "persistent":
-        run_persistent(db.Queries(db_session))
+        from telegram_ui.telegram_bot import run_persistent
+
+        run_persistent(db.Queries(init_db_session()))
+    elif RUN_MODE.lower() == "webhook":
+        from telegram_ui.telegram_bot import run_webhook
+
+        run_webhook(db.Queries(init_db_session()))
     elif RUN_MODE.lower() == "oneshot":
-        asyncio.run(run_oneshot(db.Queries(db_session)))
\ No newline at end of file
+        from oneshot import run_oneshot
+
+        asyncio.run(run_oneshot(db.Queries(init_db_session())))
@@ -0,0 +1,86 @@
+import logging
+import os
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# The metrics endpoint is only served when a port is set
+METRICS_PORT = os.environ.get("METRICS_PORT", None)
+METRICS_ADDRESS = os.environ.get("METRICS_ADDRESS", "0.0.0.0")
+
+logger = logging.getLogger(__name__)
+
+# Per-stage latencies
+FEED_FETCH_SECONDS = Histogram(
+    "llm_summarize_feed_fetch_seconds", "Time spent downloading an RSS feed", ["feed"]
+)
+FEED_PARSE_SECONDS = Histogram(
+    "llm_summarize_feed_parse_seconds", "Time spent parsing an RSS feed", ["feed"]
+)
+DB_QUERY_SECONDS = Histogram(
+    "llm_summarize_db_query_seconds", "Time spent on DB queries", ["query"]
+)
+LLM_REQUEST_SECONDS = Histogram(
+    "llm_summarize_llm_request_seconds",
+    "Time spent waiting for an LLM summary",
+    ["model"],
+    buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600),
+)
+TTS_SECONDS = Histogram(
+    "llm_summarize_tts_seconds",
+    "Time spent synthesizing TTS audio",
+    buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300),
+)
+FULL_TEXT_FETCH_SECONDS = Histogram(
+    "llm_summarize_full_text_fetch_seconds", "Time spent downloading the full text of feed entries"
+)
+TELEGRAM_SEND_SECONDS = Histogram(
+    "llm_summarize_telegram_send_seconds", "Time spent sending Telegram messages", ["method"]
+)
+
+# Entry counters
+ENTRIES_SEEN = Counter(
+    "llm_summarize_entries_seen", "Feed entries found during scans", ["model"]
+)
+ENTRIES_SKIPPED = Counter(
+    "llm_summarize_entries_skipped", "Feed entries that did not need a summary", ["model"]
+)
+ENTRIES_SUMMARIZED = Counter(
+    "llm_summarize_entries_summarized", "Feed entries that were summarized", ["model"]
+)
+ENTRIES_FAILED = Counter(
+    "llm_summarize_entries_failed", "Feed entries that could not be summarized", ["model"]
+)
+ENTRIES_ROUTED_AWAY = Counter(
+    "llm_summarize_entries_routed_away", "Feed entries left to other models because of their length", ["model"]
+)
+STAGE_ERRORS = Counter(
+    "llm_summarize_stage_errors", "Items dropped by a scan stage because of an error", ["stage"]
+)
+LLM_INPUT_TOKENS = Counter(
+    "llm_summarize_llm_input_tokens", "Tokens of the texts sent to the LLMs", ["model"]
+)
+
+# Queues
+SCAN_QUEUE_DEPTH = Gauge(
+    "llm_summarize_scan_queue_depth", "Feed entries waiting to be processed by the running scan"
+)
+UNSENT_SUMMARIES = Gauge(
+    "llm_summarize_unsent_summaries", "Summaries that have not been sent yet"
+)
+STAGE_QUEUE_DEPTH = Gauge(
+    "llm_summarize_stage_queue_depth", "Items waiting for each stage of the running scan", ["stage"]
+)
+IN_FLIGHT_REQUESTS = Gauge(
+    "llm_summarize_in_flight_requests", "Requests to external services in progress", ["service"]
+)
+
+
+def db_query_timer(query_name: str):
+    return DB_QUERY_SECONDS.labels(query=query_name).time()
+
+
+def start_metrics_server():
+    if METRICS_PORT is None:
+        return
+    logger.info(f"Serving metrics on {METRICS_ADDRESS}:{METRICS_PORT}")
+    start_http_server(int(METRICS_PORT), addr=METRICS_ADDRESS)
@@ -0,0 +1,39 @@
+import logging
+import os
+
+import tracing
+from rss_llm.rss_summarizer import RSSSummarizer
+
+# Logging settings
+DEBUG_MESSAGES = os.environ.get("DEBUG_MESSAGES", None) == "True"
+
+# Profiling settings
+PROFILE_SCAN = os.environ.get("PROFILE_SCAN", None) == "True"
+PROFILE_REPORT_PATH = os.environ.get("PROFILE_REPORT_PATH", "scan_profile.txt")
+
+logger = logging.getLogger(__name__)
+
+
+async def _scan(db_queries) -> None:
+    if not DEBUG_MESSAGES:
+        await RSSSummarizer(db_queries).summarize_rss_feeds()
+        return
+
+    # The bot is only needed to send the debug messages
+    from telegram_ui.telegram_bot import BOT_TOKEN, cron_scan, init_telegram_bot_application
+
+    application = init_telegram_bot_application(BOT_TOKEN, db_queries)
+    application.job_queue.run_once(cron_scan, when=1)
+    await application.job_queue.get_jobs_by_name("cron_scan")[0].run(application)
+
+
+async def run_oneshot(db_queries) -> None:
+    """Run a single execution of "scan"."""
+    logger.info("Starting in oneshot mode")
+    if PROFILE_SCAN:
+        profile_report = await tracing.profile(_scan(db_queries))
+        with open(PROFILE_REPORT_PATH, "w") as profile_report_file:
+            profile_report_file.write(profile_report)
+        logger.info(f"Wrote scan profile to {PROFILE_REPORT_PATH}")
+    else:
+        await _scan(db_queries)
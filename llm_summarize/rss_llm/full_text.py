@@ -0,0 +1,169 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from typing import Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+from bs4 import BeautifulSoup
+
+import metrics
+import tracing
+
+FULL_TEXT_CACHE_DIR = os.getenv("FULL_TEXT_CACHE_DIR", "full_text_cache")
+# Cached pages younger than this are used without asking the site if they changed
+FULL_TEXT_CACHE_TTL = int(os.getenv("FULL_TEXT_CACHE_TTL", "86400"))
+# Cached pages not validated for this long are deleted, by then their entries have long left the feeds
+FULL_TEXT_CACHE_MAX_AGE = int(os.getenv("FULL_TEXT_CACHE_MAX_AGE", "2592000"))
+# Politeness limits per site
+FULL_TEXT_DOMAIN_CONCURRENCY = int(os.getenv("FULL_TEXT_DOMAIN_CONCURRENCY", "2"))
+FULL_TEXT_DOMAIN_DELAY = float(os.getenv("FULL_TEXT_DOMAIN_DELAY", "1.0"))
+FULL_TEXT_TIMEOUT = int(os.getenv("FULL_TEXT_TIMEOUT", "30"))
+
+USER_AGENT = "llm_summarize full-text fetcher"
+
+# Elements that never hold the text of an article
+BOILERPLATE_TAGS = ["script", "style", "noscript", "nav", "header", "footer", "aside", "form", "iframe"]
+
+logger = logging.getLogger(__name__)
+
+
+def extract_text(html: str) -> str:
+    """Extract the paragraphs of the main content of an HTML page."""
+    soup = BeautifulSoup(html, "html.parser")
+    for boilerplate in soup(BOILERPLATE_TAGS):
+        boilerplate.decompose()
+
+    content_root = soup.find("article") or soup.find("main") or soup.body or soup
+    paragraphs = [paragraph.get_text(" ", strip=True) for paragraph in content_root.find_all("p")]
+    text = "\n\n".join(paragraph for paragraph in paragraphs if paragraph)
+    return text or content_root.get_text(" ", strip=True)
+
+
+class FullTextCache:
+    """Extracted page text on disk, keyed by URL, along with the validators needed to revalidate it."""
+
+    def __init__(self, cache_dir: str = FULL_TEXT_CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.cache_dir, f"{hashlib.sha256(url.encode()).hexdigest()}.json")
+
+    def get(self, url: str) -> Optional[dict]:
+        try:
+            with open(self._path(url)) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, url: str, text: str, etag: Optional[str], last_modified: Optional[str]):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_entry = {
+            "url": url,
+            "text": text,
+            "etag": etag,
+            "last_modified": last_modified,
+            "validated_at": time.time(),
+        }
+        # Written to a temporary file first, so that a crash never leaves a truncated entry behind
+        temporary_path = f"{self._path(url)}.tmp"
+        with open(temporary_path, "w") as cache_file:
+            json.dump(cache_entry, cache_file)
+        os.replace(temporary_path, self._path(url))
+
+    def prune(self, max_age: int = FULL_TEXT_CACHE_MAX_AGE) -> int:
+        """Delete the entries not validated for max_age seconds, and return how many were deleted."""
+        # Every validation rewrites the entry, so its modification time is when it was last validated
+        oldest_kept = time.time() - max_age
+        pruned = 0
+        try:
+            with os.scandir(self.cache_dir) as cache_files:
+                for cache_file in cache_files:
+                    try:
+                        if cache_file.stat().st_mtime < oldest_kept:
+                            os.remove(cache_file.path)
+                            pruned += 1
+                    except OSError as e:
+                        logger.error(f"Could not prune {cache_file.path} from the full text cache: {e}")
+        except FileNotFoundError:
+            pass
+        return pruned
+
+
+class FullTextFetcher:
+    """
+    Fetches the full text of feed entries, each page at most once per scan no matter how many models need it.
+    Pages are cached on disk and revalidated with their ETag or Last-Modified header once they are older than
+    FULL_TEXT_CACHE_TTL.
+    """
+
+    def __init__(self, cache: Optional[FullTextCache] = None):
+        self.cache = cache or FullTextCache()
+        self.session = None
+        self.pending_fetches = {}
+        self.domain_semaphores = defaultdict(lambda: asyncio.Semaphore(FULL_TEXT_DOMAIN_CONCURRENCY))
+        self.domain_next_request_time = defaultdict(float)
+
+    def _session(self) -> aiohttp.ClientSession:
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                headers={"User-Agent": USER_AGENT},
+                timeout=aiohttp.ClientTimeout(total=FULL_TEXT_TIMEOUT),
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def fetch(self, url: str) -> Optional[str]:
+        """Return the extracted text of the page at the URL, or None if it could not be fetched."""
+        if url not in self.pending_fetches:
+            self.pending_fetches[url] = asyncio.ensure_future(self._fetch(url))
+        return await asyncio.shield(self.pending_fetches[url])
+
+    async def _wait_for_domain(self, domain: str):
+        # Requests to the same site are spaced out by FULL_TEXT_DOMAIN_DELAY
+        now = time.monotonic()
+        request_time = max(now, self.domain_next_request_time[domain])
+        self.domain_next_request_time[domain] = request_time + FULL_TEXT_DOMAIN_DELAY
+        await asyncio.sleep(request_time - now)
+
+    async def _fetch(self, url: str) -> Optional[str]:
+        cache_entry = self.cache.get(url)
+        if cache_entry and time.time() - cache_entry["validated_at"] < FULL_TEXT_CACHE_TTL:
+            return cache_entry["text"]
+
+        headers = {}
+        if cache_entry and cache_entry["etag"]:
+            headers["If-None-Match"] = cache_entry["etag"]
+        if cache_entry and cache_entry["last_modified"]:
+            headers["If-Modified-Since"] = cache_entry["last_modified"]
+
+        domain = urlsplit(url).netloc
+        try:
+            async with self.domain_semaphores[domain]:
+                await self._wait_for_domain(domain)
+                with tracing.span("full_text.fetch", url=url), metrics.FULL_TEXT_FETCH_SECONDS.time():
+                    async with self._session().get(url, headers=headers) as response:
+                        if response.status == 304 and cache_entry:
+                            logger.info(f"Cached full text of {url} is still valid")
+                            self.cache.put(url, cache_entry["text"], cache_entry["etag"], cache_entry["last_modified"])
+                            return cache_entry["text"]
+                        response.raise_for_status()
+                        html = await response.text()
+                        etag = response.headers.get("ETag")
+                        last_modified = response.headers.get("Last-Modified")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Could not fetch the full text of {url}: {e}")
+            # A stale copy is better than nothing
+            return cache_entry["text"] if cache_entry else None
+
+        text = await asyncio.to_thread(extract_text, html)
+        self.cache.put(url, text, etag, last_modified)
+        return text
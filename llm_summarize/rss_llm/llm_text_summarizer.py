@@ -1,15 +1,14 @@
+import asyncio
+import functools
 import logging
 import os
+import re
 from html.parser import HTMLParser
 from io import StringIO
 from string import Template
 from typing import List, Tuple, Optional
 
-import ollama
 import aiohttp
-from openai import AsyncOpenAI
-import tiktoken
-from tqdm import tqdm
 
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "NONE")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "NONE")
@@ -18,6 +17,16 @@ CLOUDFLARE_AI_API_BASE_URL = os.getenv("CLOUDFLARE_AI_API_BASE_URL", "NONE")
 CLOUDFLARE_AI_API_KEY = os.getenv("CLOUDFLARE_AI_API_KEY", "NONE")
 CLOUDFLARE_AI_GATEWAY_API_KEY = os.getenv("CLOUDFLARE_AI_GATEWAY_API_KEY", "NONE")
 
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "host.docker.internal")
+# How long ollama keeps a model loaded after its last request, should outlast SCAN_INTERVAL
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+
+# Every model is routed on counts from this encoding, close enough whatever tokenizer the model uses
+TOKEN_COUNT_ENCODING = os.getenv("TOKEN_COUNT_ENCODING", "cl100k_base")
+
+# How many sentences of the text the extractive summarizers keep
+EXTRACTIVE_SUMMARY_SENTENCES = int(os.getenv("EXTRACTIVE_SUMMARY_SENTENCES", "5"))
+
 SYSTEM_PROMPT = """
 "You are an assistant that specializes in summarising long texts.
 Try to include the entirety of the text in the summary that you create.
@@ -51,10 +60,38 @@ def strip_tags(html):
     return s.get_data()
 
 
+# Tokens per character of English text, for when the encoding can not be downloaded
+ESTIMATED_TOKENS_PER_CHARACTER = 0.25
+
+
+@functools.cache
+def _token_count_encoding():
+    import tiktoken
+
+    try:
+        return tiktoken.get_encoding(TOKEN_COUNT_ENCODING)
+    except Exception as e:
+        logger.warning(f"Could not load the {TOKEN_COUNT_ENCODING} encoding, token counts are estimated: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Count the tokens of a text as it is sent to the models."""
+    model_text = strip_tags(text)
+    encoding = _token_count_encoding()
+    if encoding is None:
+        return round(len(model_text) * ESTIMATED_TOKENS_PER_CHARACTER)
+    return len(encoding.encode(model_text, disallowed_special=()))
+
+
 class LLMSummarizer:
     def __init__(self, model_name):
         self.model_name = model_name
 
+    async def warm_up(self):
+        """Prepare the backend before a batch of requests is sent to this model."""
+        pass
+
     @staticmethod
     def _messages(text_to_summarize):
         return [
@@ -92,6 +129,9 @@ class CloudflareAISummarizer(LLMSummarizer):
 
 class OpenAISummarizer(LLMSummarizer):
     def __init__(self, model_name):
+        # Provider libraries are imported on first use, so that only the providers in use slow down startup
+        from openai import AsyncOpenAI
+
         self.client = AsyncOpenAI(
             base_url=OPENAI_BASE_URL,
             api_key=OPENAI_API_KEY,
@@ -108,19 +148,127 @@ class OpenAISummarizer(LLMSummarizer):
 
 class OllamaSummarizer(LLMSummarizer):
 
-    def __init__(self, model_name, ollama_host="host.docker.internal"):
+    def __init__(self, model_name, ollama_host=OLLAMA_HOST, keep_alive=OLLAMA_KEEP_ALIVE):
+        import ollama
+
         self.client = ollama.AsyncClient(host=ollama_host)
+        self.keep_alive = keep_alive
         super().__init__(model_name)
 
+    async def warm_up(self):
+        # A generate request without a prompt only loads the model into memory
+        logger.info(f"Loading ollama model {self.model_name}")
+        await self.client.generate(self.model_name, keep_alive=self.keep_alive)
+
     async def summarize(self, text):
         response = await self.client.chat(
             self.model_name,
             messages=self._messages(text),
+            keep_alive=self.keep_alive,
         )
 
         return response.message.content
 
 
+class ExtractiveSummarizer(LLMSummarizer):
+    """
+    Summarizes locally by picking the most central sentences of the text, without any network or GPU. The model name
+    picks how sentences are scored: "textrank" ranks them by PageRank over their TF-IDF similarity graph, "tfidf" by
+    their similarity to the TF-IDF vector of the whole text.
+    """
+
+    ALGORITHMS = ("textrank", "tfidf")
+    # Any script and either case may start a sentence
+    SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+(?=[\"'(\[«“]?[^\W_])")
+    WORD = re.compile(r"[^\W\d_]{2,}")
+    STOP_WORDS = frozenset(
+        "a about after all also an and any are as at be been but by can could did do does for from had has have he "
+        "her his how i if in into is it its just more most my no not of on one only or other our out over she so "
+        "some such than that the their them then there these they this those to up us was we were what when which "
+        "who will with would you your".split()
+    )
+    TEXTRANK_DAMPING = 0.85
+    TEXTRANK_ITERATIONS = 50
+    TEXTRANK_TOLERANCE = 1e-6
+    # Only the start of very long texts is scored, which bounds the sentences x words matrix
+    MAX_SCORED_SENTENCES = 500
+    # Texts with more sentences are summarized in a thread, so that they do not hold up the event loop
+    THREAD_SENTENCE_COUNT = 100
+
+    def __init__(self, model_name, sentence_count=EXTRACTIVE_SUMMARY_SENTENCES):
+        import numpy
+
+        if model_name not in self.ALGORITHMS:
+            raise ValueError(f"Unknown extractive summarizer {model_name}, use one of {', '.join(self.ALGORITHMS)}")
+        self.numpy = numpy
+        self.sentence_count = sentence_count
+        super().__init__(model_name)
+
+    def _sentences(self, text: str) -> List[str]:
+        plain_text = " ".join(strip_tags(text).split())
+        return [sentence for sentence in self.SENTENCE_BOUNDARY.split(plain_text) if sentence]
+
+    def _tfidf_matrix(self, sentences: List[str]):
+        """One L2-normalized TF-IDF row per sentence."""
+        numpy = self.numpy
+        vocabulary = {}
+        sentence_indices, word_indices = [], []
+        for sentence_index, sentence in enumerate(sentences):
+            for word in self.WORD.findall(sentence.lower()):
+                if word not in self.STOP_WORDS:
+                    sentence_indices.append(sentence_index)
+                    word_indices.append(vocabulary.setdefault(word, len(vocabulary)))
+
+        term_counts = numpy.zeros((len(sentences), len(vocabulary)), dtype=numpy.float32)
+        numpy.add.at(term_counts, (sentence_indices, word_indices), 1)
+        document_frequencies = numpy.count_nonzero(term_counts, axis=0)
+        inverse_document_frequencies = numpy.log((1 + len(sentences)) / (1 + document_frequencies)) + 1
+        tfidf = term_counts * inverse_document_frequencies
+        norms = numpy.linalg.norm(tfidf, axis=1, keepdims=True)
+        return numpy.divide(tfidf, norms, out=numpy.zeros_like(tfidf), where=norms > 0)
+
+    def _textrank_scores(self, tfidf):
+        numpy = self.numpy
+        similarities = tfidf @ tfidf.T
+        numpy.fill_diagonal(similarities, 0)
+        out_weights = similarities.sum(axis=1, keepdims=True)
+        # Sentences sharing no words with any other link to every sentence alike
+        transitions = numpy.divide(
+            similarities, out_weights, out=numpy.full_like(similarities, 1 / len(similarities)), where=out_weights > 0
+        )
+        scores = numpy.full(len(similarities), 1 / len(similarities))
+        for _ in range(self.TEXTRANK_ITERATIONS):
+            next_scores = (1 - self.TEXTRANK_DAMPING) / len(scores) + self.TEXTRANK_DAMPING * (transitions.T @ scores)
+            if numpy.abs(next_scores - scores).sum() < self.TEXTRANK_TOLERANCE:
+                return next_scores
+            scores = next_scores
+        return scores
+
+    def _tfidf_scores(self, tfidf):
+        return tfidf @ tfidf.mean(axis=0)
+
+    def summarize_sync(self, text: str) -> str:
+        return self._summarize_sentences(self._sentences(text))
+
+    def _summarize_sentences(self, sentences: List[str]) -> str:
+        sentences = sentences[:self.MAX_SCORED_SENTENCES]
+        if len(sentences) <= self.sentence_count:
+            return " ".join(sentences)
+
+        tfidf = self._tfidf_matrix(sentences)
+        scores = self._textrank_scores(tfidf) if self.model_name == "textrank" else self._tfidf_scores(tfidf)
+        # The best sentences, in the order of the text
+        selected_indices = sorted(self.numpy.argsort(-scores, kind="stable")[:self.sentence_count])
+        return " ".join(sentences[sentence_index] for sentence_index in selected_indices)
+
+    async def summarize(self, text):
+        sentences = self._sentences(text)
+        if len(sentences) > self.THREAD_SENTENCE_COUNT:
+            return await asyncio.to_thread(self._summarize_sentences, sentences)
+        # A typical article takes under a millisecond, less than handing it to a thread
+        return self._summarize_sentences(sentences)
+
+
 class OpenAISummarizerChunked(OpenAISummarizer):
     def __init__(self, model_name, detail=0.8):
         self.detail = detail
@@ -129,6 +277,8 @@ class OpenAISummarizerChunked(OpenAISummarizer):
         super().__init__(model_name)
 
     def tokenize(self, text: str) -> List[str]:
+        import tiktoken
+
         encoding = tiktoken.encoding_for_model(self.model_name.split('/')[-1])
         return encoding.encode(text)
 
@@ -234,6 +384,8 @@ class OpenAISummarizerChunked(OpenAISummarizer):
         system_message_content = "Rewrite this text in summarized form."
 
 
+        from tqdm import tqdm
+
         accumulated_summaries = []
         for chunk in tqdm(text_chunks):
             if summarize_recursively and accumulated_summaries:
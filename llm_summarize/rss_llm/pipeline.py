@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import os
+from typing import AsyncIterator, Callable, Iterable, Optional
+
+import metrics
+
+# Items waiting between two stages, a full queue holds the stage before it back
+STAGE_QUEUE_SIZE = int(os.getenv("STAGE_QUEUE_SIZE", "16"))
+
+logger = logging.getLogger(__name__)
+
+# Tells a worker that no more items will come
+_STAGE_DONE = object()
+
+
+class Stage:
+    """
+    A step of a pipeline, run by its own workers. The handler is an async generator, each item it yields is passed
+    on to the next stage. An item that fails is handed to on_error and dropped, without stopping the stage.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[object], AsyncIterator],
+        workers: int,
+        on_error: Optional[Callable[[object, Exception], None]] = None,
+        queue_size: int = STAGE_QUEUE_SIZE,
+    ):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.on_error = on_error
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+    async def put(self, item):
+        await self.queue.put(item)
+        metrics.STAGE_QUEUE_DEPTH.labels(self.name).set(self.queue.qsize())
+
+    async def _get(self):
+        item = await self.queue.get()
+        metrics.STAGE_QUEUE_DEPTH.labels(self.name).set(self.queue.qsize())
+        return item
+
+    async def run_worker(self, next_stage: Optional["Stage"]):
+        while (item := await self._get()) is not _STAGE_DONE:
+            try:
+                async for output in self.handler(item):
+                    if next_stage is not None:
+                        await next_stage.put(output)
+            except Exception as e:
+                logger.exception(f"The {self.name} stage failed on an item")
+                metrics.STAGE_ERRORS.labels(self.name).inc()
+                if self.on_error is not None:
+                    self.on_error(item, e)
+
+
+async def run_pipeline(items: Iterable, stages: list):
+    """Pass the items through the stages, which all run at the same time, and return once every stage is drained."""
+    stage_workers = []
+    for stage_index, stage in enumerate(stages):
+        next_stage = stages[stage_index + 1] if stage_index + 1 < len(stages) else None
+        stage_workers.append(
+            [
+                asyncio.create_task(stage.run_worker(next_stage), name=f"{stage.name}-{worker_index}")
+                for worker_index in range(stage.workers)
+            ]
+        )
+
+    try:
+        for item in items:
+            await stages[0].put(item)
+        # A stage is only closed once the stage before it is done, so no item is left behind
+        for stage, workers in zip(stages, stage_workers):
+            for _ in workers:
+                await stage.put(_STAGE_DONE)
+            await asyncio.gather(*workers)
+    finally:
+        for workers in stage_workers:
+            for worker in workers:
+                worker.cancel()
@@ -1,124 +1,358 @@
 import asyncio
+import dataclasses
 import datetime
+import functools
 import logging
 import json
+import os
 import uuid
+from typing import Optional
 
+import aiohttp
 import feedparser
 
 from requests.exceptions import HTTPError
 
 import db
+import metrics
+import tracing
 import rss_llm.llm_text_summarizer as llm_text_summarizer
-from kokoro_tts.kokoro_tts import create_audio_file_docker
+from rss_llm import pipeline
+from rss_llm.full_text import FullTextFetcher
+from kokoro_tts.kokoro_tts import TTS_MODE, create_audio_file_docker
 
 logger = logging.getLogger(__name__)
 
 VIABLE_SUMMARY_LENGTH = 100
 
+# Workers per scan stage, the LLM and TTS stages bound the requests in flight to their backends
+SCAN_FETCH_WORKERS = int(os.getenv("SCAN_FETCH_WORKERS", "4"))
+SCAN_PARSE_WORKERS = int(os.getenv("SCAN_PARSE_WORKERS", "2"))
+SCAN_DEDUPE_WORKERS = int(os.getenv("SCAN_DEDUPE_WORKERS", "4"))
+SCAN_SUMMARIZE_WORKERS = int(os.getenv("SCAN_SUMMARIZE_WORKERS", "8"))
+SCAN_TTS_WORKERS = int(os.getenv("SCAN_TTS_WORKERS", "2"))
+SCAN_PERSIST_WORKERS = int(os.getenv("SCAN_PERSIST_WORKERS", "1"))
+
+# The last model used by a scan, which a self-hosted backend is most likely to still have loaded
+_last_scheduled_model_name = None
+
+# Audio being voiced after the scan, by summary key, shared by the sends and the prefetching that wait for it
+_pending_summary_audio = {}
+
+
+def _forget_summary_audio(summary_key: tuple, pending_audio: asyncio.Future):
+    # A failed synthesis is retried by the next send
+    _pending_summary_audio.pop(summary_key, None)
+    if not pending_audio.cancelled() and pending_audio.exception() is not None:
+        logger.error(f"Could not voice summary {summary_key}: {pending_audio.exception()}")
+
+
+def transcript_text(title: str, summary: str) -> str:
+    return f"Title:{title}. {summary} "
+
+
+@dataclasses.dataclass
+class ScanEntry:
+    """A feed entry on its way through the scan stages."""
+
+    feed: db.RssFeed
+    entry: feedparser.FeedParserDict
+    entry_guid: str
+    content: Optional[str] = None
+    input_tokens: Optional[int] = None
+    summary: Optional[str] = None
+    audio_file_path: Optional[str] = None
+
+
 class RSSSummarizer:
 
     def __init__(self, db_query):
         self.db_query = db_query
+        self.full_text_fetcher = None
+        # Every model routes on the same counts, so each entry is only tokenized once per scan
+        self.entry_token_counts = {}
 
         self.init_timestamp = datetime.datetime.now().isoformat()
 
     @staticmethod
-    def _rss_feed_entries(feed_url):
-        parsed_feed = feedparser.parse(feed_url)
-        return parsed_feed.entries
+    def _schedule_models(models: list) -> list:
+        """Order the models so that each backend only has to switch between its models once per scan."""
+        scheduled_models = sorted(models, key=lambda model: (model.provider_class, model.provider_specific_id))
+        model_names = [model.name for model in scheduled_models]
+        if _last_scheduled_model_name in model_names:
+            # Start with the model left loaded by the previous scan and wrap around
+            first_model_index = model_names.index(_last_scheduled_model_name)
+            scheduled_models = scheduled_models[first_model_index:] + scheduled_models[:first_model_index]
+        return scheduled_models
 
-    async def _process_rss_feed_entry(self, model: db.Model, feed: db.RssFeed, entry) -> bool:
-        entry_guid = getattr(entry, "id", entry.link)
-        logger.info(f"Processing entry {entry_guid} ...")
-        existing_summary = self.db_query.select_existing_summary_from_model(
-            feed_entry_id=entry_guid, model_name=model.name
+    @staticmethod
+    def _routes_feed(model: db.Model, feed: db.RssFeed) -> bool:
+        return feed.model_name is None or feed.model_name == model.name
+
+    @staticmethod
+    def _routes_input_tokens(model: db.Model, feed: db.RssFeed, input_tokens: int) -> bool:
+        # A feed override takes its entries whatever their length
+        if feed.model_name == model.name:
+            return True
+        if model.min_input_tokens is not None and input_tokens < model.min_input_tokens:
+            return False
+        if model.max_input_tokens is not None and input_tokens > model.max_input_tokens:
+            return False
+        return True
+
+    async def _entry_token_count(self, feed: db.RssFeed, entry_guid: str, entry_content: str) -> int:
+        entry_key = (feed.name, entry_guid)
+        if entry_key not in self.entry_token_counts:
+            with tracing.span("llm.count_tokens", feed=feed.name, entry=entry_guid):
+                self.entry_token_counts[entry_key] = await asyncio.to_thread(
+                    llm_text_summarizer.count_tokens, entry_content
+                )
+        return self.entry_token_counts[entry_key]
+
+    @staticmethod
+    def _summarizer_model(model: db.Model):
+        model_provider_class = getattr(
+            llm_text_summarizer, model.provider_class
         )
+        return model_provider_class(model.provider_specific_id)
+
+    @staticmethod
+    def _finish_entry():
+        metrics.SCAN_QUEUE_DEPTH.dec()
+
+    async def _fetch_feed(self, feed: db.RssFeed):
+        try:
+            with tracing.span("feed_fetch", feed=feed.name), metrics.FEED_FETCH_SECONDS.labels(feed.name).time():
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(feed.url) as response:
+                        response.raise_for_status()
+                        feed_content = await response.read()
+        except aiohttp.ClientError as e:
+            logger.error(f"Could not fetch feed {feed.name}: {e}")
+            return
+
+        yield feed, feed_content
+
+    async def _parse_feed(self, fetched_feed: tuple):
+        feed, feed_content = fetched_feed
+        with tracing.span("feed_parse", feed=feed.name), metrics.FEED_PARSE_SECONDS.labels(feed.name).time():
+            parsed_feed = await asyncio.to_thread(feedparser.parse, feed_content)
+        logger.info(f"Got {len(parsed_feed.entries)} feed entries from {feed.name}")
+
+        for entry in parsed_feed.entries:
+            entry_guid = entry.get("id") or entry.get("link")
+            if not entry_guid:
+                logger.info(f"Skipping an entry of {feed.name} without an id or a link")
+                continue
+            metrics.SCAN_QUEUE_DEPTH.inc()
+            yield ScanEntry(feed=feed, entry=entry, entry_guid=entry_guid)
+
+    def _entry_content(self, scan_entry: ScanEntry, full_text: Optional[str]) -> Optional[str]:
+        entry = scan_entry.entry
+        if "content" in entry:
+            return "".join([content_part.value for content_part in entry.content])
+        elif full_text and len(full_text) > VIABLE_SUMMARY_LENGTH:
+            return full_text
+        elif "summary" in entry and len(entry.summary) > VIABLE_SUMMARY_LENGTH:
+            return entry.summary
+        return None
+
+    async def _dedupe_entry(self, model: db.Model, scan_entry: ScanEntry):
+        feed, entry, entry_guid = scan_entry.feed, scan_entry.entry, scan_entry.entry_guid
+        logger.info(f"Processing entry {entry_guid} ...")
+        metrics.ENTRIES_SEEN.labels(model.name).inc()
+        with tracing.span("db.select_existing_summary_from_model", feed=feed.name, model=model.name, entry=entry_guid):
+            existing_summary = self.db_query.select_existing_summary_from_model(
+                feed_entry_id=entry_guid, model_name=model.name
+            )
 
         if existing_summary:
             logger.info(
                 f"Found guid and model match, skipping pair {entry_guid} and {model.name}"
             )
-            return False
+            metrics.ENTRIES_SKIPPED.labels(model.name).inc()
+            self._finish_entry()
+            return
 
-        existing_raw_feed_content = self.db_query.select_existing_raw_feed_content(
-            feed_entry_id=entry_guid, feed_name=feed.name
-        )
+        with tracing.span("db.select_existing_raw_feed_content", feed=feed.name, entry=entry_guid):
+            existing_raw_feed_content = self.db_query.select_existing_raw_feed_content(
+                feed_entry_id=entry_guid, feed_name=feed.name
+            )
 
         if not existing_raw_feed_content:
             logger.info(f"Saving raw feed entry data for entry {entry_guid}")
-            self.db_query.insert_rss_feed_entry(
-                feed.name, entry_guid, json.dumps(entry)
-            )
+            with tracing.span("db.insert_rss_feed_entry", feed=feed.name, entry=entry_guid):
+                self.db_query.insert_rss_feed_entry(
+                    feed.name, entry_guid, json.dumps(entry)
+                )
 
         else:
             logger.info(
                 f"Raw feed entry for {feed.name}-{entry_guid} already exists"
             )
 
+        full_text = None
+        if "content" not in entry and feed.fetch_full_text and "link" in entry:
+            full_text = await self.full_text_fetcher.fetch(entry.link)
+
+        scan_entry.content = self._entry_content(scan_entry, full_text)
+        if scan_entry.content is None:
+            logger.info(f" Could not find content to summarize in {entry_guid}")
+            metrics.ENTRIES_SKIPPED.labels(model.name).inc()
+            self._finish_entry()
+            return
+
+        scan_entry.input_tokens = await self._entry_token_count(feed, entry_guid, scan_entry.content)
+        if not self._routes_input_tokens(model, feed, scan_entry.input_tokens):
+            logger.info(f"Leaving {entry_guid} with {scan_entry.input_tokens} tokens to other models than {model.name}")
+            metrics.ENTRIES_ROUTED_AWAY.labels(model.name).inc()
+            self._finish_entry()
+            return
+
+        yield scan_entry
+
+    async def _summarize_entry(self, model: db.Model, summarizer_model, scan_entry: ScanEntry):
+        metrics.LLM_INPUT_TOKENS.labels(model.name).inc(scan_entry.input_tokens)
         try:
-            model_provider_class = getattr(
-                llm_text_summarizer, model.provider_class
-            )
-            summarizer_model = model_provider_class(model.provider_specific_id)
-            if "content" in entry:
-                entry_content = "".join([content_part.value for content_part in entry.content])
-            elif "summary" in entry and len(entry.summary) > VIABLE_SUMMARY_LENGTH :
-                entry_content = entry.summary
-            else:
-                logger.info(f" Could not find content to summarize in {entry_guid}")
-                return False
-            text_summary = await summarizer_model.summarize(entry_content)
+            with (
+                tracing.span(
+                    "llm.summarize", feed=scan_entry.feed.name, model=model.name, entry=scan_entry.entry_guid
+                ),
+                metrics.IN_FLIGHT_REQUESTS.labels("llm").track_inprogress(),
+                metrics.LLM_REQUEST_SECONDS.labels(model.name).time(),
+            ):
+                scan_entry.summary = await summarizer_model.summarize(scan_entry.content)
         except HTTPError as e:
             logger.error(
-                f"Got an HTTP error: {e.response} while processing {entry_guid}"
+                f"Got an HTTP error: {e.response} while processing {scan_entry.entry_guid}"
             )
-            return False
+            metrics.ENTRIES_FAILED.labels(model.name).inc()
+            self._finish_entry()
+            return
+        # Only the summary is needed from here on
+        scan_entry.content = None
 
-        transcript_text = f"Title:{entry.title}. {text_summary} "
-        audio_file_path = await create_audio_file_docker(transcript_text, uuid.uuid4().hex)
+        yield scan_entry
 
-        self.db_query.insert_summary(
-            feed_name=feed.name,
-            model_name=model.name,
-            feed_entry_id=entry_guid,
-            content=text_summary,
-            title=entry.title,
-            audio_file_path=audio_file_path,
-        )
-        logger.info(f"Finished with entry {feed.name}-{entry_guid}-{model.name}")
-        return True
+    async def _synthesize_entry(self, scan_entry: ScanEntry):
+        with tracing.span("tts.create_audio_file", feed=scan_entry.feed.name, entry=scan_entry.entry_guid):
+            scan_entry.audio_file_path = await create_audio_file_docker(
+                transcript_text(scan_entry.entry.title, scan_entry.summary), uuid.uuid4().hex
+            )
 
-    async def _process_rss_feed(self, model: db.Model, feed: db.RssFeed):
-        feed_entries = self._rss_feed_entries(feed.url)
-        logger.info(f"Got {len(feed_entries)} feed entries")
+        yield scan_entry
 
-        coroutines = []
-        for entry in feed_entries:
-            coroutines.append(asyncio.Task(self._process_rss_feed_entry(model, feed, entry)))
+    async def _persist_entry(self, model: db.Model, scan_entry: ScanEntry):
+        with tracing.span(
+            "db.insert_summary", feed=scan_entry.feed.name, model=model.name, entry=scan_entry.entry_guid
+        ):
+            self.db_query.insert_summary(
+                feed_name=scan_entry.feed.name,
+                model_name=model.name,
+                feed_entry_id=scan_entry.entry_guid,
+                content=scan_entry.summary,
+                title=scan_entry.entry.title,
+                audio_file_path=scan_entry.audio_file_path,
+            )
+        logger.info(f"Finished with entry {scan_entry.feed.name}-{scan_entry.entry_guid}-{model.name}")
+        metrics.ENTRIES_SUMMARIZED.labels(model.name).inc()
+        self._finish_entry()
+        yield scan_entry
 
-        await asyncio.gather(*coroutines)
+    def _entry_failed(self, model: db.Model, scan_entry: ScanEntry, error: Exception):
+        metrics.ENTRIES_FAILED.labels(model.name).inc()
+        self._finish_entry()
 
+    def _scan_stages(self, model: db.Model, summarizer_model) -> list:
+        entry_failed = functools.partial(self._entry_failed, model)
+        stages = [
+            pipeline.Stage("fetch", self._fetch_feed, SCAN_FETCH_WORKERS),
+            pipeline.Stage("parse", self._parse_feed, SCAN_PARSE_WORKERS),
+            pipeline.Stage(
+                "dedupe", functools.partial(self._dedupe_entry, model), SCAN_DEDUPE_WORKERS, entry_failed
+            ),
+            pipeline.Stage(
+                "summarize",
+                functools.partial(self._summarize_entry, model, summarizer_model),
+                SCAN_SUMMARIZE_WORKERS,
+                entry_failed,
+            ),
+            pipeline.Stage("tts", self._synthesize_entry, SCAN_TTS_WORKERS, entry_failed),
+            pipeline.Stage("persist", functools.partial(self._persist_entry, model), SCAN_PERSIST_WORKERS, entry_failed),
+        ]
+        if TTS_MODE != "scan":
+            # The audio is only voiced once the summary is sent or asked for
+            stages = [stage for stage in stages if stage.name != "tts"]
+        return stages
 
     async def summarize_rss_feeds(self):
-        active_models = self.db_query.select_active_models()
+        # Shared by all models, so that each page is only fetched once per scan
+        self.full_text_fetcher = FullTextFetcher()
+        pruned = await asyncio.to_thread(self.full_text_fetcher.cache.prune)
+        if pruned:
+            logger.info(f"Pruned {pruned} pages from the full text cache")
+        try:
+            with tracing.trace("summarize_rss_feeds"):
+                await self._summarize_rss_feeds()
+        finally:
+            await self.full_text_fetcher.close()
+
+    async def _summarize_rss_feeds(self):
+        global _last_scheduled_model_name
+        active_models = self._schedule_models(self.db_query.select_active_models())
 
+        # Models are processed one at a time, so that all requests for a model are drained before switching
         for model in active_models:
             logger.info(
                 f"Using model: {model.name} with provider: {model.provider_class} and identifier: {model.provider_specific_id}"
             )
+            _last_scheduled_model_name = model.name
+            try:
+                summarizer_model = self._summarizer_model(model)
+            except Exception as e:
+                # A misconfigured model must not keep the other models from running
+                logger.error(f"Skipping model {model.name}, which could not be set up: {e}")
+                continue
+            try:
+                with tracing.span("llm.warm_up", model=model.name):
+                    await summarizer_model.warm_up()
+            except Exception as e:
+                logger.warning(f"Could not warm up model {model.name}: {e}")
+
+            rss_feeds = [feed for feed in self.db_query.select_active_rss_feeds() if self._routes_feed(model, feed)]
+            with tracing.span("scan_pipeline", model=model.name):
+                await pipeline.run_pipeline(rss_feeds, self._scan_stages(model, summarizer_model))
+
+    async def _create_summary_audio(self, summary: db.Summary) -> str:
+        with tracing.span(
+            "tts.create_audio_file", feed=summary.feed_name, model=summary.model_name, entry=summary.feed_entry_id
+        ):
+            audio_file_path = await create_audio_file_docker(
+                transcript_text(summary.title, summary.content), uuid.uuid4().hex
+            )
+        self.db_query.update_summary_audio_file_path(summary, audio_file_path)
+        return audio_file_path
+
+    def _pending_audio(self, summary: db.Summary) -> asyncio.Future:
+        summary_key = (summary.feed_name, summary.model_name, summary.feed_entry_id)
+        if summary_key not in _pending_summary_audio:
+            pending_audio = asyncio.ensure_future(self._create_summary_audio(summary))
+            pending_audio.add_done_callback(functools.partial(_forget_summary_audio, summary_key))
+            _pending_summary_audio[summary_key] = pending_audio
+        return _pending_summary_audio[summary_key]
 
-            rss_feeds = self.db_query.select_active_rss_feeds()
-            coroutines = []
-            for feed in rss_feeds:
-                logger.info(f"Processing feed: {feed.name}")
-                coroutines.append(asyncio.Task(self._process_rss_feed(model, feed)))
+    async def summary_audio(self, summary: db.Summary) -> str:
+        """Voice a summary that has no audio yet, at most once however many sends wait for it."""
+        return await asyncio.shield(self._pending_audio(summary))
 
-            await asyncio.gather(*coroutines)
-        return
+    def prefetch_summary_audio(self, summary: db.Summary):
+        """Start voicing a summary that is about to be sent."""
+        if summary.audio_file_path is None:
+            self._pending_audio(summary)
 
     def new_summaries(self):
         unsent_summaries = self.db_query.select_unsent_summaries()
         logger.info(f"Unsent summary count: {len(unsent_summaries)}")
+        metrics.UNSENT_SUMMARIES.set(len(unsent_summaries))
 
         return unsent_summaries
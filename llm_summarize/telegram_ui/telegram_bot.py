@@ -1,26 +1,50 @@
 
+import asyncio
+import io
 import logging
 import os
 import uuid
 
 from psycopg.errors import UniqueViolation
 
-from kokoro_tts.kokoro_tts import create_audio_file_docker
+import metrics
+import tracing
+from delivery import SummaryQueue
+from kokoro_tts.kokoro_tts import TTS_MODE, TTS_PREFETCH, create_audio_file_docker, is_voice_note
+from rss_llm.llm_text_summarizer import ExtractiveSummarizer
 from rss_llm.rss_summarizer import RSSSummarizer
 
-from telegram import Update, ReplyKeyboardMarkup
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, ReplyKeyboardMarkup
 from telegram.constants import ParseMode
-from telegram.ext import AIORateLimiter, Application, CommandHandler, filters, MessageHandler, ContextTypes, ConversationHandler, CallbackContext
+from telegram.error import Forbidden, TelegramError
+from telegram.ext import AIORateLimiter, Application, BaseUpdateProcessor, CallbackQueryHandler, CommandHandler, filters, MessageHandler, ContextTypes, ConversationHandler, CallbackContext
 
 
 # Telegram-related settings
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", None)
 CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID", None)
+# Only needs to be set when using a local Bot API server
+TELEGRAM_API_BASE_URL = os.environ.get("TELEGRAM_API_BASE_URL", None)
 
 # Intervals and message send limits
 SCAN_INTERVAL = int(os.environ.get("SCAN_INTERVAL", "900"))
-SEND_INTERVAL = int(os.environ.get("SEND_INTERVAL", "60"))
+# Summaries are delivered as soon as they are ready, the scheduled send only catches the ones that were missed
+SEND_INTERVAL = int(os.environ.get("SEND_INTERVAL", "600"))
 MAX_SUMMARIES_PER_SEND = 10
+# Seconds between two summaries delivered as soon as they are ready, keeps the bot within Telegram's limits
+DELIVERY_INTERVAL = float(os.environ.get("DELIVERY_INTERVAL", "2"))
+
+# Webhook mode settings, the webhook server expects plain HTTP behind an HTTPS terminator
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET_TOKEN = os.environ.get("WEBHOOK_SECRET_TOKEN", None)
+# The public HTTPS URL registered with Telegram, required in webhook mode
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", None)
+# Updates of different chats are processed concurrently, the updates of one chat still one by one
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "8"))
+# Replicas that only serve commands can leave the scheduled scans and sends to a single instance
+RUN_SCHEDULED_JOBS = os.environ.get("RUN_SCHEDULED_JOBS", "True") == "True"
 
 # Logging settings
 DEBUG_MESSAGES = os.environ.get("DEBUG_MESSAGES", None) == "True"
@@ -28,7 +52,7 @@ DEBUG_MESSAGES = os.environ.get("DEBUG_MESSAGES", None) == "True"
 logger = logging.getLogger(__name__)
 
 # Model provider classes
-MODEL_PROVIDER_CLASSES = ["CloudflareAISummarizer", "OpenAISummarizer", "OllamaSummarizer", "OpenAISummarizerChunked"]
+MODEL_PROVIDER_CLASSES = ["CloudflareAISummarizer", "OpenAISummarizer", "OllamaSummarizer", "OpenAISummarizerChunked", "ExtractiveSummarizer"]
 
 # New model conversation states
 MODEL_NAME, MODEL_PROVIDER_NAME = range(2)
@@ -36,18 +60,67 @@ MODEL_NAME, MODEL_PROVIDER_NAME = range(2)
 # New feed conversation states
 FEED_NAME, FEED_URL = range(2)
 
+# Callback data prefix of the buttons that voice a summary on request
+AUDIO_BUTTON_PREFIX = "tts:"
+
+# Keeps the scheduled send and the delivery of ready summaries from sending the same summary twice
+summary_delivery_lock = asyncio.Lock()
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes the updates of different chats concurrently, and the updates of each chat one by one, since the
+    conversation handlers rely on the updates of a conversation arriving in order.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self.chat_locks = {}
+        self.chat_lock_users = {}
+
+    async def process_update(self, update, coroutine) -> None:
+        # The chat lock is taken before the semaphore, so updates waiting on a busy chat do not hold up other chats
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await super().process_update(update, coroutine)
+            return
+
+        chat_lock = self.chat_locks.setdefault(chat.id, asyncio.Lock())
+        self.chat_lock_users[chat.id] = self.chat_lock_users.get(chat.id, 0) + 1
+        try:
+            async with chat_lock:
+                await super().process_update(update, coroutine)
+        finally:
+            # Locks are dropped once no update of the chat is waiting, so they do not pile up
+            self.chat_lock_users[chat.id] -= 1
+            if self.chat_lock_users[chat.id] == 0:
+                del self.chat_lock_users[chat.id]
+                del self.chat_locks[chat.id]
+
+    async def do_process_update(self, update, coroutine) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
 def init_telegram_bot_application(
-    bot_token: str, db_queries, read_timeout=60, write_timeout=60
+    bot_token: str, db_queries, read_timeout=60, write_timeout=60, concurrent_updates=False
 ) -> Application:
     # Create the Application and pass it your bot's token.
-    bot_application = (
+    bot_application_builder = (
         Application.builder()
         .token(bot_token)
         .read_timeout(read_timeout)
         .write_timeout(write_timeout)
         .rate_limiter(AIORateLimiter())
-        .build()
+        .concurrent_updates(concurrent_updates)
     )
+    if TELEGRAM_API_BASE_URL:
+        bot_application_builder = bot_application_builder.base_url(TELEGRAM_API_BASE_URL)
+    bot_application = bot_application_builder.build()
     bot_application.bot_data['db_queries'] = db_queries
     return bot_application
 
@@ -59,46 +132,219 @@ def telegram_message_from_summary(summary):
 async def reply_send(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info("Sending all new entries")
     await update.message.reply_text("Sending all new entries...")
-    unsent_summaries = RSSSummarizer(context.bot_data['db_queries']).new_summaries()
-    if len(unsent_summaries) > 0 or DEBUG_MESSAGES:
-        await update.message.reply_text(
-            text=f"{len(unsent_summaries)} new entries are available"
-        )
-    else:
-        await update.message.reply_text(text="No new entries are available")
+    db_queries = context.bot_data['db_queries']
+    chat_id = update.effective_chat.id
+
+    async with summary_delivery_lock:
+        if str(chat_id) != CHAT_ID:
+            # Subscribed chats only get the summaries of their subscriptions
+            pending_deliveries = db_queries.select_pending_deliveries(MAX_SUMMARIES_PER_SEND, chat_id=chat_id)
+            if pending_deliveries:
+                await update.message.reply_text(text=f"Sending {len(pending_deliveries)} new entries")
+                await _send_pending_deliveries(context.bot, db_queries, pending_deliveries)
+            else:
+                await update.message.reply_text(text="No new entries are available")
+            return
+
+        unsent_summaries = RSSSummarizer(db_queries).new_summaries()
+        if len(unsent_summaries) > 0 or DEBUG_MESSAGES:
+            await update.message.reply_text(
+                text=f"{len(unsent_summaries)} new entries are available"
+            )
+        else:
+            await update.message.reply_text(text="No new entries are available")
+            return
+
+        summaries_to_send = unsent_summaries[:MAX_SUMMARIES_PER_SEND]
+        for summary_index, summary in enumerate(summaries_to_send):
+            _prefetch_audio(db_queries, summaries_to_send[summary_index:summary_index + TTS_PREFETCH + 1])
+            await _send_summary_to_default_chat(context.bot, db_queries, summary)
+
+
+async def cron_send(context: ContextTypes.DEFAULT_TYPE) -> None:
+    with tracing.trace("cron_send"):
+        await _cron_send(context)
+
+
+def _prefetch_audio(db_queries, summaries: list) -> None:
+    if TTS_MODE != "delivery":
         return
+    for summary in summaries:
+        RSSSummarizer(db_queries).prefetch_summary_audio(summary)
 
-    for summary in unsent_summaries[:MAX_SUMMARIES_PER_SEND]:
-        logger.info(f"Sending summary of: {summary.feed_entry_id}")
-        await update.message.reply_text(text=telegram_message_from_summary(summary))
 
-        await update.message.reply_audio(summary.audio_file_path, title=summary.title, performer="Kokoro TTS")
+def _audio_button(db_queries, summary) -> InlineKeyboardMarkup:
+    if summary.audio_token is None:
+        db_queries.update_summary_audio_token(summary, uuid.uuid4().hex)
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton("Listen", callback_data=f"{AUDIO_BUTTON_PREFIX}{summary.audio_token}")]]
+    )
 
-        logger.info(f"Sent summary of: {summary.feed_entry_id}")
-        context.bot_data['db_queries'].update_summary_sent(
-            summary.feed_name, summary.model_name, summary.feed_entry_id
+
+async def _send_summary_audio(bot, db_queries, summary, chat_id) -> None:
+    if summary.audio_file_path is None:
+        await RSSSummarizer(db_queries).summary_audio(summary)
+
+    # The audio is uploaded once, every later chat gets it by the file id Telegram returned
+    audio = summary.audio_file_id or summary.audio_file_path
+    if is_voice_note(summary.audio_file_path):
+        with tracing.span("telegram.send_voice"), metrics.TELEGRAM_SEND_SECONDS.labels("send_voice").time():
+            audio_message = await bot.send_voice(chat_id=chat_id, voice=audio)
+        audio_file_id = audio_message.voice.file_id
+    else:
+        with tracing.span("telegram.send_audio"), metrics.TELEGRAM_SEND_SECONDS.labels("send_audio").time():
+            audio_message = await bot.send_audio(
+                chat_id=chat_id, audio=audio, title=summary.title, performer="Kokoro TTS"
+            )
+        audio_file_id = audio_message.audio.file_id
+    if summary.audio_file_id is None:
+        db_queries.update_summary_audio_file_id(summary, audio_file_id)
+
+
+async def _send_summary_text(bot, db_queries, summary, chat_id) -> bool:
+    """Send the text of a summary, and return whether its audio should follow."""
+    logger.info(f"Sending summary of: {summary.feed_entry_id} to chat {chat_id}")
+    # Summaries without audio get a button to voice them instead, unless they are voiced before delivery
+    ask_for_audio = TTS_MODE == "button" and summary.audio_file_path is None
+    if TTS_MODE == "delivery" and summary.audio_file_path is None:
+        # Voiced before the text is sent, so that a TTS failure can not leave a text without its audio
+        try:
+            await RSSSummarizer(db_queries).summary_audio(summary)
+        except Exception as e:
+            logger.error(f"Could not voice summary {summary.feed_entry_id}, sending it with a Listen button: {e}")
+            ask_for_audio = True
+
+    with tracing.span("telegram.send_message"), metrics.TELEGRAM_SEND_SECONDS.labels("send_message").time():
+        await bot.send_message(
+            chat_id=chat_id,
+            text=telegram_message_from_summary(summary),
+            reply_markup=_audio_button(db_queries, summary) if ask_for_audio else None,
         )
-        logger.info(f"Recorded send of: {summary.feed_entry_id}")
+    return not ask_for_audio
 
 
-async def cron_send(context: ContextTypes.DEFAULT_TYPE) -> None:
-    logger.info("Sending all new entries")
+async def _send_summary(bot, db_queries, summary, chat_id) -> None:
+    if await _send_summary_text(bot, db_queries, summary, chat_id):
+        await _send_summary_audio(bot, db_queries, summary, chat_id)
+    logger.info(f"Sent summary of: {summary.feed_entry_id} to chat {chat_id}")
 
-    unsent_summaries = RSSSummarizer(context.bot_data['db_queries']).new_summaries()
-    if len(unsent_summaries) > 0 or DEBUG_MESSAGES:
-        await context.bot.send_message(
-            chat_id=CHAT_ID, text=f"{len(unsent_summaries)} new summaries are available"
-        )
-    for summary in unsent_summaries[:MAX_SUMMARIES_PER_SEND]:
-        logger.info(f"Sending summary of: {summary.feed_entry_id}")
-        await context.bot.send_message(
-            chat_id=CHAT_ID, text=telegram_message_from_summary(summary)
+
+async def send_requested_audio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    db_queries = context.bot_data['db_queries']
+    summary = db_queries.select_summary_by_audio_token(query.data.removeprefix(AUDIO_BUTTON_PREFIX))
+    if summary is None:
+        await query.answer("This summary is no longer available")
+        return
+
+    logger.info(f"Voicing summary of: {summary.feed_entry_id} on request")
+    await query.answer()
+    await query.edit_message_reply_markup(reply_markup=None)
+    await _send_summary_audio(context.bot, db_queries, summary, query.message.chat.id)
+
+
+async def _send_summary_to_default_chat(bot, db_queries, summary) -> None:
+    await _send_summary(bot, db_queries, summary, CHAT_ID)
+    with tracing.span("db.update_summary_sent"):
+        db_queries.update_summary_sent(summary.feed_name, summary.model_name, summary.feed_entry_id)
+    logger.info(f"Recorded send of: {summary.feed_entry_id}")
+
+
+async def _send_summary_to_subscriber(bot, db_queries, summary, chat_id) -> None:
+    # A delivery retried after its audio failed only sends the audio again
+    summary_delivery = db_queries.select_summary_delivery(summary, chat_id)
+    if summary_delivery is None or not summary_delivery.text_delivered:
+        send_audio = await _send_summary_text(bot, db_queries, summary, chat_id)
+        db_queries.update_summary_delivery_text_delivered(summary, chat_id)
+    else:
+        send_audio = True
+    if send_audio:
+        await _send_summary_audio(bot, db_queries, summary, chat_id)
+    with tracing.span("db.insert_summary_delivery"):
+        db_queries.insert_summary_delivery(summary, chat_id)
+    logger.info(f"Recorded delivery of: {summary.feed_entry_id} to chat {chat_id}")
+
+
+async def _send_summary_to_subscriber_or_drop(bot, db_queries, summary, chat_id) -> None:
+    try:
+        await _send_summary_to_subscriber(bot, db_queries, summary, chat_id)
+    except Forbidden as e:
+        # The bot was blocked or removed from the chat, its pending summaries would otherwise hold up everyone else
+        logger.error(f"Dropping the subscriptions of chat {chat_id}, which can no longer be sent to: {e}")
+        db_queries.delete_chat_subscriptions(chat_id)
+    except TelegramError as e:
+        # Retried on later sends, after the deliveries that did not fail yet
+        logger.error(f"Could not deliver summary {summary.feed_entry_id} to chat {chat_id}: {e}")
+        db_queries.update_summary_delivery_failed(summary, chat_id)
+
+
+async def _send_pending_deliveries(bot, db_queries, pending_deliveries: list) -> None:
+    for delivery_index, (summary, chat_id) in enumerate(pending_deliveries):
+        # The next few summaries are voiced while this one is sent
+        _prefetch_audio(
+            db_queries,
+            [summary for summary, _ in pending_deliveries[delivery_index:delivery_index + TTS_PREFETCH + 1]],
         )
-        await context.bot.send_audio(chat_id=CHAT_ID, audio=summary.audio_file_path, title="TTS")
+        await _send_summary_to_subscriber_or_drop(bot, db_queries, summary, chat_id)
 
-        logger.info(f"Sent summary of: {summary.feed_entry_id}")
-        context.bot_data['db_queries'].update_summary_sent(summary.feed_name, summary.model_name, summary.feed_entry_id)
-        logger.info(f"Recorded send of: {summary.feed_entry_id}")
+
+async def _cron_send(context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info("Sending all new entries")
+    db_queries = context.bot_data['db_queries']
+
+    async with summary_delivery_lock:
+        if CHAT_ID:
+            unsent_summaries = RSSSummarizer(db_queries).new_summaries()
+            if len(unsent_summaries) > 0 or DEBUG_MESSAGES:
+                await context.bot.send_message(
+                    chat_id=CHAT_ID, text=f"{len(unsent_summaries)} new summaries are available"
+                )
+            summaries_to_send = unsent_summaries[:MAX_SUMMARIES_PER_SEND]
+            for summary_index, summary in enumerate(summaries_to_send):
+                # The next few summaries are voiced while this one is sent
+                _prefetch_audio(db_queries, summaries_to_send[summary_index:summary_index + TTS_PREFETCH + 1])
+                await _send_summary_to_default_chat(context.bot, db_queries, summary)
+
+        pending_deliveries = db_queries.select_pending_deliveries(MAX_SUMMARIES_PER_SEND)
+        await _send_pending_deliveries(context.bot, db_queries, pending_deliveries)
+
+
+async def deliver_ready_summaries(application: Application, summary_queue: SummaryQueue) -> None:
+    """Send each summary as soon as it is ready, runs for as long as the bot does."""
+    db_queries = application.bot_data['db_queries']
+    while True:
+        summary_key = await summary_queue.get()
+        try:
+            async with summary_delivery_lock:
+                summary = db_queries.select_summary(*summary_key)
+                if summary is None:
+                    continue
+                if CHAT_ID and not summary.sent:
+                    await _send_summary_to_default_chat(application.bot, db_queries, summary)
+                for chat_id in db_queries.select_pending_delivery_chat_ids(summary):
+                    await _send_summary_to_subscriber_or_drop(application.bot, db_queries, summary, chat_id)
+        except Exception as e:
+            # The scheduled send will pick the summary up later
+            logger.error(f"Could not deliver summary {summary_key}: {e}")
+        await asyncio.sleep(DELIVERY_INTERVAL)
+
+
+async def start_summary_delivery(application: Application) -> None:
+    summary_queue = SummaryQueue()
+    db_queries = application.bot_data['db_queries']
+    db_queries.summary_listeners.append(summary_queue.put)
+
+    delivery_tasks = [asyncio.create_task(deliver_ready_summaries(application, summary_queue))]
+    db_url = db_queries.session.bind.url
+    if db_url.get_backend_name() == "postgresql":
+        # Summaries inserted by other processes, like oneshot scans, are announced through Postgres
+        delivery_tasks.append(asyncio.create_task(summary_queue.listen_postgres(db_url)))
+    application.bot_data['delivery_tasks'] = delivery_tasks
+
+
+async def stop_summary_delivery(application: Application) -> None:
+    for delivery_task in application.bot_data.get('delivery_tasks', []):
+        delivery_task.cancel()
 
 
 async def reply_scan(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -109,6 +355,16 @@ async def reply_scan(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     await update.message.reply_text(f"Got new entries")
 
 
+async def reply_profile_scan(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info("Starting profiled RSS feed scan")
+    await update.message.reply_text("Scanning RSS feeds under the profiler...")
+
+    profile_report = await tracing.profile(RSSSummarizer(context.bot_data['db_queries']).summarize_rss_feeds())
+    await update.message.reply_document(
+        document=io.BytesIO(profile_report.encode()), filename="scan_profile.txt"
+    )
+
+
 async def cron_scan(context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info("Starting scheduled RSS feed scan")
     if DEBUG_MESSAGES:
@@ -147,6 +403,134 @@ async def delete_feed(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         )
 
 
+async def full_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        feed_name = context.args[0]
+        fetch_full_text = {"on": True, "off": False}[context.args[1].lower()]
+
+        logger.info(f"Setting full text fetching of feed {feed_name} to {fetch_full_text}")
+        if context.bot_data['db_queries'].update_rss_feed_full_text(name=feed_name, fetch_full_text=fetch_full_text):
+            await update.message.reply_text(f"Full text fetching of feed {feed_name} is {context.args[1].lower()}")
+        else:
+            await update.message.reply_text(f"Feed {feed_name} does not exist")
+    except (IndexError, KeyError):
+        await update.message.reply_text(
+            "Invalid parameters. Usage: full_text <feed_name> <on|off>"
+        )
+
+
+async def feed_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        feed_name = context.args[0]
+        model_name = None if context.args[1] == "all" else context.args[1]
+    except IndexError:
+        await update.message.reply_text(
+            "Invalid parameters. Usage: feed_model <feed_name> <model_name|all>"
+        )
+        return
+
+    db_queries = context.bot_data['db_queries']
+    if model_name and model_name not in {model.name for model in db_queries.select_active_models()}:
+        await update.message.reply_text(f"Model {model_name} does not exist")
+        return
+
+    logger.info(f"Routing the entries of feed {feed_name} to model {model_name}")
+    if db_queries.update_rss_feed_model(name=feed_name, model_name=model_name):
+        await update.message.reply_text(f"Feed {feed_name} is summarized by {model_name or 'all models'}")
+    else:
+        await update.message.reply_text(f"Feed {feed_name} does not exist")
+
+
+async def model_tokens(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        model_name = context.args[0]
+        min_input_tokens, max_input_tokens = (
+            None if token_limit == "-" else int(token_limit) for token_limit in context.args[1:3]
+        )
+    except (IndexError, ValueError):
+        await update.message.reply_text(
+            "Invalid parameters. Usage: model_tokens <model_name> <min_tokens|-> <max_tokens|->"
+        )
+        return
+
+    logger.info(f"Routing entries of {min_input_tokens} to {max_input_tokens} tokens to model {model_name}")
+    if context.bot_data['db_queries'].update_model_input_tokens(model_name, min_input_tokens, max_input_tokens):
+        await update.message.reply_text(
+            f"Model {model_name} gets entries of {min_input_tokens or 0} to {max_input_tokens or 'any number of'} tokens"
+        )
+    else:
+        await update.message.reply_text(f"Model {model_name} does not exist")
+
+
+def _subscription_arguments(context: ContextTypes.DEFAULT_TYPE) -> tuple:
+    feed_name = context.args[0]
+    model_name = context.args[1] if len(context.args) > 1 else None
+    return feed_name, model_name
+
+
+def _subscription_description(feed_name: str, model_name: str) -> str:
+    return f"{feed_name} summarized by {model_name}" if model_name else f"{feed_name} summarized by every model"
+
+
+async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        feed_name, model_name = _subscription_arguments(context)
+    except IndexError:
+        await update.message.reply_text(
+            "Invalid parameters. Usage: subscribe <feed_name> [model_name]"
+        )
+        return
+
+    chat_id = update.effective_chat.id
+    if str(chat_id) == CHAT_ID:
+        await update.message.reply_text("This chat already gets every summary")
+        return
+
+    db_queries = context.bot_data['db_queries']
+    if feed_name not in {feed.name for feed in db_queries.select_active_rss_feeds()}:
+        await update.message.reply_text(f"Feed {feed_name} does not exist")
+        return
+    if model_name and model_name not in {model.name for model in db_queries.select_active_models()}:
+        await update.message.reply_text(f"Model {model_name} does not exist")
+        return
+
+    logger.info(f"Subscribing chat {chat_id} to {feed_name}, model {model_name}")
+    if db_queries.insert_subscription(chat_id, feed_name, model_name):
+        await update.message.reply_text(f"Subscribed to {_subscription_description(feed_name, model_name)}")
+    else:
+        await update.message.reply_text(f"Already subscribed to {_subscription_description(feed_name, model_name)}")
+
+
+async def unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        feed_name, model_name = _subscription_arguments(context)
+    except IndexError:
+        await update.message.reply_text(
+            "Invalid parameters. Usage: unsubscribe <feed_name> [model_name]"
+        )
+        return
+
+    chat_id = update.effective_chat.id
+    logger.info(f"Unsubscribing chat {chat_id} from {feed_name}, model {model_name}")
+    if context.bot_data['db_queries'].delete_subscription(chat_id, feed_name, model_name):
+        await update.message.reply_text(f"Unsubscribed from {_subscription_description(feed_name, model_name)}")
+    else:
+        await update.message.reply_text(f"Not subscribed to {_subscription_description(feed_name, model_name)}")
+
+
+async def list_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    subscriptions = context.bot_data['db_queries'].select_chat_subscriptions(update.effective_chat.id)
+    if subscriptions:
+        await update.message.reply_text(
+            "Subscribed to:\n" + "\n".join(
+                _subscription_description(subscription.feed_name, subscription.model_name)
+                for subscription in subscriptions
+            )
+        )
+    else:
+        await update.message.reply_text("No subscriptions, use /subscribe <feed_name> [model_name]")
+
+
 async def delete_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
         model_name = context.args[0]
@@ -166,7 +550,10 @@ async def send_tts_audio(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
         logger.info(f"Replying with voiced text: {tts_text} ")
         audio_file_path = await create_audio_file_docker(tts_text, uuid.uuid4().hex)
-        await update.message.reply_audio(audio_file_path, title="TTS")
+        if is_voice_note(audio_file_path):
+            await update.message.reply_voice(audio_file_path)
+        else:
+            await update.message.reply_audio(audio_file_path, title="TTS")
     except (IndexError, ValueError):
         await update.message.reply_text(
             "Invalid parameters. Usage: tts <text>"
@@ -196,7 +583,15 @@ async def handle_model_provider_choice(update: Update, context: CallbackContext)
         context.user_data['model_provider_class'] = user_choice
 
         # Ask the user for the name of the model
-        await update.message.reply_text("Great! Now, please provide the name of the model:")
+        if user_choice == "ExtractiveSummarizer":
+            await update.message.reply_text(
+                "Great! Now, please choose how sentences are scored:",
+                reply_markup=ReplyKeyboardMarkup(
+                    [list(ExtractiveSummarizer.ALGORITHMS)], one_time_keyboard=True, resize_keyboard=True
+                ),
+            )
+        else:
+            await update.message.reply_text("Great! Now, please provide the name of the model:")
 
         # Transition to the DONE_ADDING_MODEL state
         return MODEL_NAME
@@ -213,6 +608,10 @@ async def handle_model_name(update: Update, context: CallbackContext) -> int:
     # Retrieve the user's choice from context.user_data
     provider_class = context.user_data.get('model_provider_class', None)
 
+    if provider_class == "ExtractiveSummarizer" and model_name not in ExtractiveSummarizer.ALGORITHMS:
+        await update.message.reply_text(f"Please choose one of: {', '.join(ExtractiveSummarizer.ALGORITHMS)}")
+        return MODEL_NAME
+
     if model_name:
         # Thank the user for their input
         try:
@@ -288,21 +687,20 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     message = f"An exception was raised: {context.error}"
 
     # Finally, send the message
+    if CHAT_ID is None:
+        return
     await context.bot.send_message(
         chat_id=CHAT_ID, text=message, parse_mode=ParseMode.HTML
     )
 
 
-def run_persistent(db_queries) -> None:
-    """Run the bot in persistent mode."""
-    logger.info("Starting in persistent mode")
-
-    application = init_telegram_bot_application(BOT_TOKEN, db_queries)
-
-    job_queue = application.job_queue
-    job_queue.run_repeating(cron_scan, interval=SCAN_INTERVAL, first=5)
-    job_queue.run_repeating(cron_send, interval=SEND_INTERVAL, first=30)
-
+def add_jobs_and_handlers(application: Application) -> None:
+    if RUN_SCHEDULED_JOBS:
+        job_queue = application.job_queue
+        job_queue.run_repeating(cron_scan, interval=SCAN_INTERVAL, first=5)
+        job_queue.run_repeating(cron_send, interval=SEND_INTERVAL, first=30)
+        application.post_init = start_summary_delivery
+        application.post_shutdown = stop_summary_delivery
 
     add_model_conv_handler = ConversationHandler(
         entry_points=[CommandHandler("add_model", add_model_convo)],
@@ -328,20 +726,54 @@ def run_persistent(db_queries) -> None:
 
     application.add_handler(CommandHandler("ping", ping))
     application.add_handler(CommandHandler("scan", reply_scan))
+    application.add_handler(CommandHandler("profile_scan", reply_profile_scan))
     application.add_handler(CommandHandler("send", reply_send))
     application.add_handler(CommandHandler("delete_feed", delete_feed))
+    application.add_handler(CommandHandler("full_text", full_text))
     application.add_handler(CommandHandler("delete_model", delete_model))
+    application.add_handler(CommandHandler("feed_model", feed_model))
+    application.add_handler(CommandHandler("model_tokens", model_tokens))
+    application.add_handler(CommandHandler("subscribe", subscribe))
+    application.add_handler(CommandHandler("unsubscribe", unsubscribe))
+    application.add_handler(CommandHandler("subscriptions", list_subscriptions))
     application.add_handler(CommandHandler("tts", send_tts_audio))
+    application.add_handler(CallbackQueryHandler(send_requested_audio, pattern=f"^{AUDIO_BUTTON_PREFIX}"))
 
     application.add_error_handler(error_handler)
 
+
+def run_persistent(db_queries) -> None:
+    """Run the bot in persistent mode."""
+    logger.info("Starting in persistent mode")
+
+    application = init_telegram_bot_application(BOT_TOKEN, db_queries)
+    metrics.start_metrics_server()
+    add_jobs_and_handlers(application)
+
     # Run the bot until the user presses Ctrl-C
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
-async def run_oneshot(db_queries) -> None:
-    """Run a single execution of "scan"."""
-    logger.info("Starting in oneshot mode")
-    application = init_telegram_bot_application(BOT_TOKEN, db_queries)
-    application.job_queue.run_once(cron_scan, when=1)
-    await application.job_queue.get_jobs_by_name("cron_scan")[0].run(application)
+def run_webhook(db_queries) -> None:
+    """Run the bot in webhook mode, receiving updates from Telegram instead of polling for them."""
+    if not WEBHOOK_URL:
+        # Telegram would otherwise be given a URL derived from the listen address, which it rejects
+        raise ValueError("WEBHOOK_URL must be set to the public HTTPS URL of the webhook in webhook mode")
+    logger.info(f"Starting in webhook mode, listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+
+    application = init_telegram_bot_application(
+        BOT_TOKEN, db_queries, concurrent_updates=PerChatUpdateProcessor(CONCURRENT_UPDATES)
+    )
+    metrics.start_metrics_server()
+    add_jobs_and_handlers(application)
+
+    # Run the bot until the user presses Ctrl-C
+    application.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET_TOKEN,
+        webhook_url=WEBHOOK_URL,
+        allowed_updates=Update.ALL_TYPES,
+    )
+
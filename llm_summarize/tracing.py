@@ -0,0 +1,108 @@
+import asyncio
+import contextlib
+import contextvars
+import datetime
+import json
+import logging
+import os
+import time
+
+# Scan traces are only recorded when a directory to write them to is set
+TRACE_DIR = os.environ.get("TRACE_DIR", None)
+
+logger = logging.getLogger(__name__)
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """Collects the spans of one scan as Chrome trace events, with one track per asyncio task."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started_at = datetime.datetime.now()
+        self.start = time.perf_counter()
+        self.events = []
+        self.task_ids = {}
+
+    def _task_id(self) -> int:
+        task = asyncio.current_task()
+        if task not in self.task_ids:
+            self.task_ids[task] = len(self.task_ids)
+            self.events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": self.task_ids[task],
+                    "args": {"name": task.get_name() if task else "main"},
+                }
+            )
+        return self.task_ids[task]
+
+    def add_span(self, name: str, start: float, end: float, attributes: dict):
+        self.events.append(
+            {
+                "name": name,
+                "ph": "X",
+                "ts": (start - self.start) * 1_000_000,
+                "dur": (end - start) * 1_000_000,
+                "pid": os.getpid(),
+                "tid": self._task_id(),
+                "args": attributes,
+            }
+        )
+
+    def write(self, directory: str) -> str:
+        os.makedirs(directory, exist_ok=True)
+        trace_path = os.path.join(
+            directory, f"{self.name}-{self.started_at.strftime('%Y%m%dT%H%M%S%f')}.json"
+        )
+        with open(trace_path, "w") as trace_file:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, trace_file)
+        return trace_path
+
+
+@contextlib.contextmanager
+def trace(name: str):
+    """Record the spans created inside this block and write them to TRACE_DIR when it exits."""
+    if TRACE_DIR is None or _current_trace.get() is not None:
+        yield
+        return
+
+    current_trace = Trace(name)
+    token = _current_trace.set(current_trace)
+    try:
+        with span(name):
+            yield
+    finally:
+        _current_trace.reset(token)
+        trace_path = current_trace.write(TRACE_DIR)
+        logger.info(f"Wrote trace of {name} to {trace_path}")
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    current_trace = _current_trace.get()
+    if current_trace is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current_trace.add_span(name, start, time.perf_counter(), attributes)
+
+
+async def profile(coroutine) -> str:
+    """Await a coroutine under a sampling profiler and return the text report."""
+    from pyinstrument import Profiler
+
+    profiler = Profiler(async_mode="enabled")
+    profiler.start()
+    try:
+        await coroutine
+    finally:
+        profiler.stop()
+    return profiler.output_text(unicode=True, show_all=False)